@@ -1,7 +1,10 @@
 import numpy as np
 import pandas as pd
-from trendmaster import trend
 import pickle
+import batchTrend
+import bootstrap
+import dataStore
+import significance
 
 def saveDict(dictionary,filename):
     """
@@ -38,12 +41,23 @@ def openDict(filename):
     loadedDict = pickle.load(pickle_in)
     return loadedDict
 
-sor = openDict("sorlandet_final")
-ost = openDict("ostlandet_final")
-vest = openDict("vestlandet_final")
-trond = openDict("trondelag_final")
-nord = openDict("nordland_final")
-finn = openDict("finnmark_final")
+def loadRegion(region):
+    """
+    Loads the organised data of a region, from the data store if it exists,
+    else from the pickled dictionary.
+    
+    Parameters
+    ----------
+    region: str
+        short name of region, e.g. "sor"
+    
+    Returns
+    -------
+    dictionary
+    """
+    if dataStore.exists():
+        return dataStore.loadRegion(region)
+    return openDict(f"{dataStore.REGIONS[region]}_final")
 
 def annualSum(ts,years=30,endYear = 2012):
     """
@@ -79,131 +93,324 @@ def annualSum(ts,years=30,endYear = 2012):
             t.append(tslice.sum(skipna=False))
     return np.array(t)
 
-def annualET(data, years = 30):
+def hydrologicalYears(df,years=30,endYear=2012,how="sum",startMonth=9,maxMissing=0.1,present=None):
+    """
+    Aggregates daily data of many series to norwegian hydrological years in one pass.
+    
+    Each day is labelled once with the year its hydrological year starts in, and
+    all series are reduced together. A year is missing if more than
+    ceil(maxMissing*days) of its days are missing, as in annualSum.
+    
+    Parameters
+    ----------
+    df: pandas.DataFrame or pandas.Series
+        daily data with datetime index and one series per column
+    years: int
+        number of years in period
+    endYear: int
+        year the last hydrological year starts in
+    how: str
+        {"sum","mean"}
+    startMonth: int
+        first month of the year, 9 for the hydrological year (Sep-Aug), 1 for calendar years
+    maxMissing: float
+        largest allowed fraction of missing days, None to allow any
+    present: pandas.DataFrame
+        True where a series has a row in its own index, if df is the union of
+        series with different indices, default is all rows
+    
+    Returns
+    -------
+    numpy.array
+        array of shape (year,series)
+    """
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
+        present = None if present is None else present.loc[df.index]
+    values = np.asarray(df,dtype=float).reshape(len(df),-1)
+    if present is None:
+        present = np.ones(values.shape,dtype=bool)
+    else:
+        present = np.asarray(present,dtype=bool).reshape(values.shape)
+    label = np.asarray(df.index.year) - (np.asarray(df.index.month) < startMonth) - (endYear-years+1)
+    keep = (label>=0) & (label<years)
+    values, present, label = values[keep], present[keep], label[keep]
+    # first day of each year, years without days are empty slices
+    bounds = np.searchsorted(label,np.arange(years))
+    empty = np.append(bounds[1:]==bounds[:-1],bounds[-1]==len(label))
+    
+    def reduce(x):
+        # a row of zeros at the end keeps the bounds of empty last years valid
+        x = np.concatenate((x,np.zeros((1,x.shape[1]),dtype=x.dtype)))
+        out = np.add.reduceat(x,bounds,axis=0).astype(float)
+        out[empty] = 0
+        return out
+    
+    missing = np.isnan(values) & present
+    total = reduce(present)
+    out = reduce(np.where(missing,0,np.nan_to_num(values)))
+    if how == "mean":
+        with np.errstate(divide="ignore",invalid="ignore"):
+            out = out/(total - reduce(missing))
+    elif how != "sum":
+        raise ValueError(f"Unknown aggregation: {how}")
+    if maxMissing is not None:
+        out[reduce(missing) > np.ceil(total*maxMissing)] = np.nan
+    return out
+
+def Tmean(temp,endYear=2012,years=30):
+    """
+    Mean annual temperature of calendar years, as in the annual trends notebook.
+    
+    Parameters
+    ----------
+    temp: pandas.DataFrame or pandas.Series
+        daily temperature with datetime index, one column per catchment
+    endYear: int
+    years: int
+        number of years in analysis period ending with endYear
+    
+    Returns
+    -------
+    numpy.array of mean annual temperature, shape (year,catchment)
+    """
+    T = hydrologicalYears(temp,years=years,endYear=endYear,how="mean",startMonth=1,maxMissing=None)
+    T[T==0] = np.nan
+    return T
+
+VARIABLES = ("evapo","runoff","rain","snow","precip")
+
+def annualArray(data, years = 30, endYear = 2012):
+    """
+    Calculates hydrological year totals of runoff, rainfall, snowmelt, precipitation and
+    evapotranspiration for all catchments of a region in one pass.
+    
+    Parameters
+    ----------
+    data: dictionary
+        organised data of a region
+    years: int
+        number of years in period
+    endYear: int
+    
+    Returns
+    -------
+    numpy.array
+        array of shape (year,catchment,variable), variables ordered as VARIABLES
+    """
     df = data["metadata"]
-    evapo = {}
-    for c in data[f"final{years}"]:
+    catchments = list(data[f"final{years}"])
+    series = []
+    for c in catchments:
         area = (df[df.snumber==c].areal).iloc[0]
-        Q = annualSum((data["data"][c]["runoff"].runoff)*(86.4)/area,years=years)
-        rainfall = annualSum(data["data"][c]["precip"],years=years)
-        snowmelt = annualSum(data["data"][c]["snow"].qsw,years=years)
-        P = rainfall + snowmelt
-        ET = P - Q
-        evapo[c] = ET
-    return evapo
+        series.append((data["data"][c]["runoff"].runoff)*(86.4)/area)
+    for c in catchments:
+        series.append(data["data"][c]["precip"])
+    for c in catchments:
+        series.append(data["data"][c]["snow"].qsw)
+    keys = range(len(series))
+    daily = pd.concat(series,axis=1,keys=keys)
+    # days outside a series' own index are not counted, as in annualSum
+    present = pd.concat([pd.Series(True,index=ts.index) for ts in series],axis=1,keys=keys).reindex(daily.index)
+    totals = hydrologicalYears(daily,years=years,endYear=endYear,present=present.notna())
+    Q, rainfall, snowmelt = np.split(totals,3,axis=1)
+    P = rainfall + snowmelt
+    return np.stack((P - Q, Q, rainfall, snowmelt, P),axis=-1)
+
+def annualET(data, years = 30):
+    annual = annualArray(data,years=years)
+    return {c:annual[:,i,0] for i,c in enumerate(data[f"final{years}"])}
 
-def annualAllVariables(data, years = 30):
+def annualAllVariables(data, years = 30, endYear = 2012):
     """
     Calculates annual data from daily data for runoff, rainfall, snowmelt, precipitation, and evapotraspiration.
     Evapotranspiration is calculated using the water balance equation, and assumes changes in annual storage is zero.
     """
-    df = data["metadata"]
-    evapo = {}
-    runoff = {}
-    rain = {}
-    snow = {}
-    precip = {}
-    for c in data[f"final{years}"]:
-        area = (df[df.snumber==c].areal).iloc[0]
-        Q = annualSum((data["data"][c]["runoff"].runoff)*(86.4)/area,years=years)
-        rainfall = annualSum(data["data"][c]["precip"],years=years)
-        snowmelt = annualSum(data["data"][c]["snow"].qsw,years=years)
-        P = rainfall + snowmelt
-        ET = P - Q
-        evapo[c] = ET
-        runoff[c] = Q
-        rain[c] = rainfall
-        snow[c] = snowmelt
-        precip[c] = P
-    years = range(2013-years,2013)
-    return pd.DataFrame(evapo,index=years),pd.DataFrame(runoff,index=years),pd.DataFrame(rain,index=years),pd.DataFrame(snow,index=years),pd.DataFrame(precip,index=years)
+    annual = annualArray(data,years=years,endYear=endYear)
+    catchments = list(data[f"final{years}"])
+    index = range(endYear-years+1,endYear+1)
+    return tuple(pd.DataFrame(annual[:,:,i],index=index,columns=catchments) for i in range(len(VARIABLES)))
 
-def resampling(df,years):
+def resampling(df,years,seed=None):
     """
         Resampling procedure after Burn and Hag Elnur, 2002.
+        
+        Draws the last years years of df with replacement, the same years for all catchments.
         """
-    years = np.arange(2013-years,2013)
-    ## bootstrap procedure
-    resampled = {}
-    catchments = list(df.columns)
-    
-    for c in catchments:
-        ts = []
-        for i in range(len(years)):
-            # select random year
-            year = np.random.choice(years)
-            # get values for that year
-            resampled[i] = np.array(df.loc[year])
+    index = bootstrap.resamplingTable(1,1,years,seed=seed)[0,0]
+    return df.iloc[-years:].iloc[index].reset_index(drop=True)
 
-    return pd.DataFrame.from_dict(resampled,columns=catchments,orient="index")
+def fieldSignBatch(annual, index, groups, alpha = 0.05, q = 90, adaptive = False, batch = 50, confidence = 0.99,
+                   method = "bootstrap"):
+    """
+    Field significance after Burn and Hag Elnur, 2002, for many groups of catchments
+    and variables at once.
+    
+    The series are ranked once, and the Mann-Kendall test of all resampled sets of
+    years is evaluated for all catchments and variables in one call.
+    
+    Parameters
+    ----------
+    annual: numpy.array
+        annual data of shape (year,catchment,variable)
+    index: numpy.array
+        resampled years of shape (NS,year), the same years for all catchments
+    groups: numpy.array
+        group of each catchment, e.g. region, as integers from 0, or a boolean
+        matrix of shape (catchment,group) for groups that overlap, e.g. regions
+        and all catchments together
+    alpha: float
+    q: float
+        percentile of the resampled distribution used as critical value
+    adaptive: bool
+        evaluate the resampled years batch at a time, and stop for a group and
+        variable once bootstrap.decisive finds its field significance decided
+    batch: int
+    confidence: float
+        confidence level of the adaptive stopping rule
+    method: str
+        {"bootstrap","fdr","walker"}, "fdr" and "walker" test the p-values of
+        each group without resampling, see significance.analyticFieldSignificance,
+        with the critical p-value in place of the critical fraction and no
+        resampled sets of years used
+    
+    Returns
+    -------
+    tuple of numpy.array
+        critical fraction, fraction of catchments with significant trends,
+        field significance and number of resampled sets of years used,
+        all of shape (group,variable)
+    """
+    groups = np.asarray(groups)
+    # catchment to group matrix, divided by the group size
+    if groups.ndim == 1:
+        groups = groups[:,None] == np.arange(groups.max()+1)
+    weights = groups.astype(float)
+    weights /= weights.sum(axis=0)
+    
+    p = batchTrend.mannKendall(annual,axis=0)[0]
+    if method != "bootstrap":
+        results = [significance.analyticFieldSignificance(p[members].T,alpha=alpha,q=q,method=method) for members in groups.T]
+        pcrit, percentSign, significant = (np.array(r) for r in zip(*results))
+        return pcrit, percentSign, significant, np.zeros(pcrit.shape,dtype=int)
+    percentSign = np.einsum("cv,cg->gv",(p<alpha).astype(float),weights)
+    
+    NS = index.shape[0]
+    ranks = batchTrend.rankSeries(annual,axis=0)
+    distribution = np.empty((NS,)+percentSign.shape)
+    resamples = np.full(percentSign.shape,NS)
+    active = np.ones(percentSign.shape,dtype=bool)
+    step = batch if adaptive else NS
+    for used in range(0,NS,step):
+        p = batchTrend.mannKendallRanks(ranks[index[used:used+step].T],axis=0)[0]
+        distribution[used:used+step] = np.einsum("icv,cg->igv",(p<alpha).astype(float),weights)
+        if adaptive:
+            stop = min(used+step,NS)
+            decided = active & bootstrap.decisive(distribution[:stop],percentSign,q=q,confidence=confidence)
+            resamples[decided] = stop
+            active &= ~decided
+            if not active.any():
+                break
+    pcrit = np.empty(percentSign.shape)
+    for g,v in np.ndindex(*pcrit.shape):
+        pcrit[g,v] = np.percentile(distribution[:resamples[g,v],g,v],q)
+    return pcrit, percentSign, percentSign>pcrit, resamples
 
-def fieldSign(df, years, alpha = 0.05, q = 90, NS = 400, histogram=False):
+def fieldSign(df, years, alpha = 0.05, q = 90, NS = 400, histogram=False, seed=None, method="bootstrap"):
     """
     Calculating the field significance after Burn and Hag Elnur, 2002.
+    
+    All resampled sets of years are drawn as one index matrix and evaluated together.
+    The period is the last years years of df. With method "fdr" or "walker" the
+    field significance is tested from the p-values without resampling, see fieldSignBatch.
     """
-    catchments = list(df.columns)
-    
-    sign = []
-    for i in range(NS):
-        resampled = resampling(df,years=years)
-        s = 0
-        for col in catchments:
-            ts = np.array(resampled[col])
-            p = trend.mann_kendall(ts)
-            if p<alpha:
-                s += 1
-        sign.append(s/len(catchments))
-
-    distribution = np.array(sign)
-    pcrit = np.percentile(distribution,q)
+    values = np.array(df,dtype=float)[-years:]
+    index = bootstrap.resamplingTable(NS,1,years,seed=seed)[:,0]
+    pcrit, percentSign, significant, resamples = fieldSignBatch(values[:,:,None],index,np.zeros(values.shape[1],dtype=int),
+                                                             alpha=alpha,q=q,method=method)
     
     # plot histogram
     if histogram:
+        # matplotlib is only needed for the histogram
+        import matplotlib.pyplot as plt
+        ranks = batchTrend.rankSeries(values,axis=0)
+        distribution = (batchTrend.mannKendallRanks(ranks[index.T],axis=0)[0]<alpha).mean(axis=-1)
         plt.hist(distribution,edgecolor="k", linewidth=1)
         plt.xlabel("% of catchments with significant trends")
         plt.ylabel("Frequency")
         #plt.vlines(pcrit,0,NS,color="k")
         #plt.ylim(n.max()+10)
     
-    s = 0
-    for col in catchments:
-        ts = np.array(df[col])
-        p = trend.mann_kendall(ts)
-        if p<alpha:
-            s += 1
-    percentSign = s/len(catchments)
-    
-    return pcrit, percentSign, percentSign>pcrit
+    return pcrit[0,0], percentSign[0,0], significant[0,0]
 
-regionDF = {"sor":sor,
-            "ost":ost,
-            "vest":vest,
-            "trond":trond,
-            "nord":nord,
-            "finn":finn}
-regions = ["sor","ost","vest","trond","nord","finn"]
-years = [30,50]
-out = {}
+def annualFieldSignificance(regionDF, regions = ["sor","ost","vest","trond","nord","finn"], years = [30,50],
+                            alpha = 0.05, q = 90, NS = 400, seed = 0, adaptive = False, national = "norway",
+                            method = "bootstrap"):
+    """
+    Calculates the annual field significance of all variables for several regions and periods.
+    
+    The catchments of all regions are analysed together, with one set of resampled
+    years per period shared by all regions and variables, and the field
+    significance of all catchments together is reduced from the same samples.
+    
+    Parameters
+    ----------
+    regionDF: dictionary
+        organised data by region, {region:dictionary}
+    regions: list
+    years: list
+        number of years in each period
+    alpha: float
+    q: float
+    NS: int
+        number of resampled sets of years
+    seed: int
+        seed of the resampling, the results are reproducible for the same seed
+    adaptive: bool
+        stop resampling for a region and variable once its field significance is
+        decided, see fieldSignBatch, and add the number of resamples used
+    national: str
+        name of the result of all catchments together, None to leave it out
+    method: str
+        {"bootstrap","fdr","walker"}, see fieldSignBatch
+    
+    Returns
+    -------
+    dictionary
+        {"30years":{region:pandas.DataFrame}} with one row per variable, including national
+    """
+    rng = np.random.default_rng(seed)
+    out = {}
+    print("\nStarting analysis...")
+    for year in years:
+        print("-----")
+        print(f"Analysing {year} year period...")
+        annual = [annualArray(regionDF[region],years=year) for region in regions]
+        groups = np.concatenate([np.full(a.shape[1],i) for i,a in enumerate(annual)])
+        names = list(regions)
+        groups = groups[:,None] == np.arange(len(regions))
+        if national is not None:
+            groups = np.column_stack((groups,np.ones(len(groups),dtype=bool)))
+            names.append(national)
+        index = bootstrap.resamplingTable(NS,1,year,seed=rng)[:,0]
+        results = fieldSignBatch(np.concatenate(annual,axis=1),index,groups,alpha=alpha,q=q,adaptive=adaptive,
+                                 method=method)
+        columns = ["pcrit","percentSignficant","FieldSignificant","resamples"]
+        if not adaptive or method != "bootstrap":
+            results, columns = results[:3], columns[:3]
+        out[f"{year}years"] = {}
+        for i,region in enumerate(names):
+            FS = {var:tuple(r[i,v] for r in results) for v,var in enumerate(VARIABLES)}
+            out[f"{year}years"][region] = pd.DataFrame.from_dict(FS,orient="index",columns=columns)
+            print(f"\tRegion {region} complete.")
+    return out
 
-print("\nStarting analysis...")
-for year in years:
+if __name__ == "__main__":
+    regions = ["sor","ost","vest","trond","nord","finn"]
+    regionDF = {region:loadRegion(region) for region in regions}
+    out = annualFieldSignificance(regionDF,regions=regions)
+    
+    saveDict(out,"Results/FS/FieldSignificanceAnnual")
+    print("-----")
+    print("Analysis complete.")
     print("-----")
-    print(f"Analysing {year} year period...")
-    out[f"{year}years"] = {}
-    for region in regions:
-        regDF = regionDF[region]
-        varDF = annualAllVariables(regDF,years=year)
-        variables = ("evapo","runoff","rain","snow","precip")
-        FS = {}
-        for i in range(len(varDF)):
-            df = varDF[i]
-            var = variables[i]
-            results = fieldSign(df,year)
-            FS[var] = results
-        out[f"{year}years"][region] = pd.DataFrame.from_dict(FS,orient="index",columns=["pcrit","percentSignficant","FieldSignificant"])
-        print(f"\tRegion {region} complete.")
-
-saveDict(out,"Results/FS/FieldSignificanceAnnual")
-print("-----")
-print("Analysis complete.")
-print("-----")
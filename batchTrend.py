@@ -0,0 +1,357 @@
+"""
+    Batched trend statistics for arrays of many time series.
+
+    The functions operate along one axis (the year axis of the reshaped
+    (doy,year,catchment) arrays by default) and reproduce the results of the
+    USGS trend module for every series in a single call.
+    """
+
+import numpy as np
+from scipy.stats import norm, chi2
+from instrumentation import stage
+import kernels
+import compactCube
+
+def _moveYearAxis(array,axis):
+    """
+        Returns a float array with the year axis moved to the end; float32
+        arrays, e.g. compact cubes, are kept in float32, all others are float64.
+        """
+    array = np.asarray(array)
+    return np.moveaxis(array if array.dtype == np.float32 else array.astype(float),axis,-1)
+
+def mkScore(array,axis=1):
+    """
+        Computes the Mann-Kendall S statistic for every series in an array.
+
+        Missing values (NaN) are dropped from each series, as in trend.mk_score.
+
+        Parameters
+        ----------
+        array: numpy.array
+            array containing time series along one axis
+        axis: int
+            axis of the time dimension, default is the year axis of (doy,year,catchment)
+
+        Returns
+        -------
+        numpy.array
+            S statistic with the time axis removed
+        """
+    x = _moveYearAxis(array,axis)
+    n = x.shape[-1]
+    s = np.zeros(x.shape[:-1])
+    # looping over lags keeps the memory use at the size of the input array
+    for k in range(1,n):
+        diff = x[...,k:] - x[...,:-k]
+        s += np.nansum(np.sign(diff),axis=-1)
+    return s
+
+def mkScoreVariance(array,axis=1):
+    """
+        Computes the tie corrected variance of S for every series in an array.
+
+        Equation 8.4 from Helsel and Hirsch (2002), as in trend.mk_score_variance.
+
+        Parameters
+        ----------
+        array: numpy.array
+            array containing time series along one axis
+        axis: int
+            axis of the time dimension
+
+        Returns
+        -------
+        numpy.array
+            variance of S with the time axis removed
+        """
+    x = _moveYearAxis(array,axis)
+    valid = np.isfinite(x)
+    n = valid.sum(axis=-1)
+    # number of values in each value's tie group (including itself)
+    t = valid.astype(x.dtype)
+    for k in range(1,x.shape[-1]):
+        tied = x[...,k:] == x[...,:-k]
+        t[...,k:] += tied
+        t[...,:-k] += tied
+    # sum over tie groups of tp*(tp-1)*(2tp+5), written as a sum over values
+    ties = np.where(valid,(t-1)*(2*t+5),0).sum(axis=-1,dtype=float)
+    return (n*(n-1)*(2*n+5) - ties)/18
+
+def mkZ(s,varS):
+    """
+        Computes the Mann-Kendall Z statistic from S and its variance.
+        """
+    s = np.asarray(s,dtype=float)
+    with np.errstate(divide="ignore",invalid="ignore"):
+        z = np.where(s>0,(s-1)/np.sqrt(varS),np.where(s<0,(s+1)/np.sqrt(varS),0.))
+    return z
+
+def mannKendall(array,axis=1):
+    """
+        Mann-Kendall test for monotonic trend in every series of an array.
+
+        Parameters
+        ----------
+        array: numpy.array
+            array of shape: (doy,year,catchment) or any array with time along axis
+        axis: int
+            axis of the time dimension
+
+        Returns
+        -------
+        tuple of numpy.array
+            two tailed p-values and S statistics, both with the time axis removed
+        """
+    with stage("mk"):
+        s = mkScore(array,axis=axis)
+        varS = mkScoreVariance(array,axis=axis)
+        z = mkZ(s,varS)
+        p = 2*(1-norm.cdf(np.abs(z)))
+    return p, s
+
+def senSlope(array,axis=1,maxMemory=2**28):
+    """
+        Sen's slope estimator for every series in an array.
+
+        The slopes of all pairs of years are computed for a block of series at a
+        time, so that the pairwise array never exceeds the memory budget.
+
+        Parameters
+        ----------
+        array: numpy.array
+            array containing time series along one axis
+        axis: int
+            axis of the time dimension
+        maxMemory: int
+            memory budget for the pairwise slopes in bytes, default is 256 MB
+
+        Returns
+        -------
+        numpy.array
+            median of the pairwise slopes with the time axis removed
+        """
+    x = _moveYearAxis(array,axis)
+    shape = x.shape[:-1]
+    n = x.shape[-1]
+    x = x.reshape(-1,n)
+    i, j = np.triu_indices(n,1)
+    dist = (j-i).astype(x.dtype)
+    out = np.full(x.shape[0],np.nan)
+    if len(i) == 0:
+        return out.reshape(shape)
+    # the median works on a copy, hence twice the size of the pairwise array
+    chunk = max(1,int(maxMemory//(2*x.itemsize*len(i))))
+    with stage("sen"):
+        for start in range(0,x.shape[0],chunk):
+            block = x[start:start+chunk]
+            slopes = (block[:,j] - block[:,i])/dist
+            out[start:start+chunk] = np.median(slopes,axis=-1)
+    return out.reshape(shape)
+
+def autocorrelation(array,axis=1):
+    """
+        Lag-1 autocorrelation and Ljung-Box test for every series in an array.
+
+        Matches statsmodels.tsa.stattools.acf(ts,qstat=True,nlags=1).
+
+        Parameters
+        ----------
+        array: numpy.array
+            array containing time series along one axis
+        axis: int
+            axis of the time dimension
+
+        Returns
+        -------
+        tuple of numpy.array
+            lag-1 autocorrelation and Ljung-Box p-values, with the time axis removed
+        """
+    x = _moveYearAxis(array,axis)
+    n = x.shape[-1]
+    # deviations in the precision of x, sums in float64
+    d = x - x.mean(axis=-1,keepdims=True,dtype=float).astype(x.dtype)
+    with np.errstate(divide="ignore",invalid="ignore"):
+        r = (d[...,1:]*d[...,:-1]).sum(axis=-1,dtype=float)/(d*d).sum(axis=-1,dtype=float)
+    qstat = n*(n+2)*r**2/(n-1)
+    p = chi2.sf(qstat,1)
+    return r, p
+
+# identifies the prewhitening method in cache keys, change it when prewhiten changes
+PREWHITENING = "Wang-Swail lag-1"
+
+def prewhiten(array,alpha=0.05,axis=1):
+    """
+        Pre-whitening of all series with significant lag-1 autocorrelation.
+
+        After Wang&Swail, 2001:
+        https://doi.org/10.1175/1520-0442(2001)014%3C2204:COEWHI%3E2.0.CO;2
+        As in the per-series procedure of the trend scripts the first and the
+        last value of a series are kept unchanged.
+
+        Parameters
+        ----------
+        array: numpy.array
+            array containing time series along one axis
+        alpha: float
+            significance level of the Ljung-Box test
+        axis: int
+            axis of the time dimension
+
+        Returns
+        -------
+        tuple of numpy.array
+            array of the same shape with pre-whitened series, and a boolean mask
+            (time axis removed) of the series that were pre-whitened
+        """
+    x = _moveYearAxis(array,axis)
+    with stage("acf"):
+        r, p = autocorrelation(x,axis=-1)
+    with stage("prewhiten"):
+        mask = p < alpha
+        pw = x.copy()
+        rx = r[...,None].astype(x.dtype)
+        with np.errstate(divide="ignore",invalid="ignore"):
+            whitened = (x[...,1:-1] - rx*x[...,:-2])/(1 - rx)
+        pw[...,1:-1] = np.where(mask[...,None],whitened,x[...,1:-1])
+    return np.moveaxis(pw,-1,axis), mask
+
+def rankSeries(array,axis=1):
+    """
+        Dense ranks of the values within every series of an array.
+
+        Ranks keep the order and the ties of the values, so the Mann-Kendall test
+        of the ranks is identical to the test of the values. They are computed
+        once and can then be reused for every resampled version of the series.
+
+        Parameters
+        ----------
+        array: numpy.array
+            array containing time series along one axis
+        axis: int
+            axis of the time dimension
+
+        Returns
+        -------
+        numpy.array
+            integer ranks starting at 0 in the same layout as array, -1 for missing
+            values; int8 for series of up to 127 values, else int16
+        """
+    x = _moveYearAxis(array,axis)
+    dtype = np.int8 if x.shape[-1] <= 127 else np.int16
+    order = np.argsort(x,axis=-1,kind="stable")
+    ordered = np.take_along_axis(x,order,axis=-1)
+    # a new rank starts wherever the sorted value changes
+    new = np.ones(ordered.shape,dtype=dtype)
+    new[...,0] = 0
+    new[...,1:] = ordered[...,1:] != ordered[...,:-1]
+    ranks = np.empty(x.shape,dtype=dtype)
+    np.put_along_axis(ranks,order,np.cumsum(new,axis=-1,dtype=dtype),axis=-1)
+    ranks[~np.isfinite(x)] = -1
+    return np.moveaxis(ranks,-1,axis)
+
+def mannKendallRanks(ranks,axis=1):
+    """
+        Mann-Kendall test on ranks from rankSeries.
+
+        S is computed from small integer differences and the tie correction from
+        counts of equal ranks, which gives the same p-values and S statistics as
+        mannKendall on the original values at a fraction of the cost. Ranks with
+        the time dimension as the first axis (axis=0) are used without a copy.
+
+        Parameters
+        ----------
+        ranks: numpy.array
+            integer ranks, -1 for missing values
+        axis: int
+            axis of the time dimension
+
+        Returns
+        -------
+        tuple of numpy.array
+            two tailed p-values and S statistics, both with the time axis removed
+        """
+    r = np.ascontiguousarray(np.moveaxis(np.asarray(ranks),axis,0))
+    shape = r.shape[1:]
+    n = r.shape[0]
+    r = r.reshape(n,-1)
+    valid = r >= 0
+    complete = valid.all()
+    s = np.zeros(r.shape[1],dtype=np.int32)
+    # compare every year with all earlier years
+    for j in range(1,n):
+        sgn = np.sign(r[j] - r[:j])
+        if not complete:
+            sgn *= valid[j] & valid[:j]
+        s += sgn.sum(axis=0,dtype=np.int32)
+    # number of values per rank in every series, missing values go to bin n
+    bins = np.where(valid,r,n) + (n+1)*np.arange(r.shape[1])
+    t = np.bincount(bins.ravel(),minlength=(n+1)*r.shape[1]).reshape(-1,n+1)[:,:n]
+    ties = (t*(t-1)*(2*t+5)).sum(axis=-1)
+    m = valid.sum(axis=0)
+    varS = (m*(m-1)*(2*m+5) - ties)/18
+    s = s.astype(float)
+    p = 2*(1-norm.cdf(np.abs(mkZ(s,varS))))
+    return p.reshape(shape), s.reshape(shape)
+
+def trendBundle(array,alpha=0.1,maxMemory=2**28,chunk=None,backend="numpy",valid=None):
+    """
+        Trend analysis of every series in one pass: autocorrelation test,
+        prewhitening, Mann-Kendall test and Sen's slope.
+
+        Parameters
+        ----------
+        array: numpy.array
+            array of shape: (doy,year,catchment), may be memory-mapped;
+            catchments filled with -99 are treated as missing; float32 arrays
+            are analysed in float32
+        alpha: float
+            significance level for the masked trend magnitude
+        maxMemory: int
+            memory budget in bytes for the pairwise slopes
+        chunk: int
+            number of doys read and analysed at a time, default is all doys
+        backend: str
+            {"numpy","numba","auto"}, "numba" runs the compiled kernels of kernels.py
+        valid: numpy.array
+            validity mask of a compact cube, shape: (catchment,year), see compactCube.py;
+            catchments without valid years are missing, instead of those filled with -99
+
+        Returns
+        -------
+        dictionary of numpy.array, all of shape (catchment,doy):
+            "pvalue": Mann-Kendall p-values
+            "S": Mann-Kendall S statistics
+            "slope": Sen's slope
+            "significantSlope": Sen's slope where p < alpha, else NaN
+            "prewhitened": True where the series was prewhitened
+        slopes are -99 and p-values and S are NaN for missing catchments
+        """
+    days, catchments = array.shape[0], array.shape[2]
+    missing = compactCube.missing(array,valid)
+    p = np.full((days,catchments),np.nan)
+    s = np.full((days,catchments),np.nan)
+    slope = np.full((days,catchments),np.nan)
+    prewhitened = np.zeros((days,catchments),dtype=bool)
+    backend = kernels.resolve(backend)
+    if backend not in ("numpy","numba"):
+        raise ValueError(f"trendBundle has no {backend} backend")
+    step = days if chunk is None else chunk
+    for d in range(0,days,step):
+        if backend == "numba":
+            with stage("kernel"):
+                p[d:d+step], s[d:d+step], slope[d:d+step], prewhitened[d:d+step] = kernels.trendSeries(array[d:d+step])
+            continue
+        series, prewhitened[d:d+step] = prewhiten(array[d:d+step])
+        p[d:d+step], s[d:d+step] = mannKendall(series)
+        slope[d:d+step] = senSlope(series,maxMemory=maxMemory)
+    bundle = {"pvalue":p.T,
+              "S":s.T,
+              "slope":slope.T,
+              "significantSlope":np.where(p<alpha,slope,np.nan).T,
+              "prewhitened":prewhitened.T}
+    bundle["pvalue"][missing,:] = np.nan
+    bundle["S"][missing,:] = np.nan
+    bundle["slope"][missing,:] = -99
+    bundle["significantSlope"][missing,:] = -99
+    return bundle
@@ -0,0 +1,170 @@
+"""
+    Benchmarks of the trend and field significance hot paths on synthetic data.
+
+    Runs offline without data files, e.g.:
+        python benchmark.py
+        python benchmark.py --catchments 10 50 --NS 50 400 --years 30 50
+        python benchmark.py --only fieldSignDaily trendMagnitude
+
+    Each benchmark is timed, then run once more under tracemalloc for its peak
+    memory. Results are appended to Benchmarks/results.csv together with the git
+    revision, and compared with the latest results of another revision, so that
+    regressions between versions are visible.
+    """
+
+import argparse
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from pathlib import Path
+import runTrendAnalysis
+import dailyFieldSignificance
+import annualFieldSignificance
+import reshapeToArray
+
+RESULTS = "Benchmarks/results.csv"
+
+def syntheticCube(catchments,years=30,seed=0):
+    """
+    Moving average like array of shape (365,years,catchment) with trends,
+    autocorrelated years and some missing values.
+    """
+    rng = np.random.default_rng(seed)
+    season = np.sin(np.linspace(0,2*np.pi,365))[:,None,None]
+    trend = rng.normal(0,0.02,(1,1,catchments))*np.arange(years)[None,:,None]
+    noise = rng.normal(size=(365,years,catchments))
+    noise[:,1:] += 0.3*noise[:,:-1]
+    cube = 5 + 3*season + trend + noise
+    cube[rng.random(cube.shape)<0.001] = np.nan
+    return cube
+
+def syntheticDaily(catchments,years=30,seed=0):
+    """
+    Daily moving average dictionary of one region, {catchment:{"5day":pandas.Series}},
+    ending in 2012 as expected by reshapeToArray.
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(f"{2013-years}-01-01","2012-12-31")
+    return {c:{"5day":pd.Series(rng.gamma(1,3,len(dates)),index=dates)} for c in range(catchments)}
+
+def syntheticAnnual(catchments,years=30,seed=0):
+    """
+    Annual values of a variable, one column per catchment, indexed by year.
+    """
+    rng = np.random.default_rng(seed)
+    values = rng.normal(1000,100,(years,catchments)) + rng.normal(0,3,catchments)*np.arange(years)[:,None]
+    return pd.DataFrame(values,index=range(2013-years,2013))
+
+def benchmarks(catchments,years,NS):
+    """
+    Benchmarks for one combination of sizes.
+
+    Returns
+    -------
+    list of (name, function without arguments, number of series analysed)
+    """
+    cube = syntheticCube(catchments,years)
+    daily = syntheticDaily(catchments,years)
+    annual = syntheticAnnual(catchments,years)
+    series = next(iter(daily.values()))["5day"]
+    return [("trendMagnitude",lambda: runTrendAnalysis.trendMagnitude(cube),365*catchments),
+            ("fieldSignDaily",lambda: dailyFieldSignificance.fieldSignDaily(cube,NS=NS,seed=0),NS*365*catchments),
+            ("fieldSign",lambda: annualFieldSignificance.fieldSign(annual,years,NS=NS,seed=0),NS*catchments),
+            ("reshapeToArray",lambda: reshapeToArray.reshapeToArray(daily,"5day",period=years),catchments),
+            ("annualSum",lambda: [annualFieldSignificance.annualSum(series,years=years) for c in range(catchments)],catchments),
+            ("hydrologicalYears",lambda: annualFieldSignificance.hydrologicalYears(
+                pd.concat([daily[c]["5day"] for c in daily],axis=1),years=years),catchments)]
+
+def measure(function,repeat=1):
+    """
+    Best time of repeat runs in seconds, and peak memory of one run in MB.
+    """
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        function()
+        times.append(time.perf_counter()-t0)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak/1024**2
+
+def revision():
+    """
+    Short git revision of the working tree, with + if it has changes.
+    """
+    try:
+        rev = subprocess.run(["git","rev-parse","--short","HEAD"],capture_output=True,text=True,check=True).stdout.strip()
+        dirty = subprocess.run(["git","status","--porcelain","--untracked-files=no"],capture_output=True,text=True).stdout.strip()
+        return rev + ("+" if dirty else "")
+    except (OSError,subprocess.CalledProcessError):
+        return "unknown"
+
+def run(catchments=(10,50),years=(30,50),NS=(50,),only=None,repeat=1,resultFile=RESULTS):
+    """
+    Runs all benchmarks for all combinations of sizes and appends the results to resultFile.
+
+    Returns
+    -------
+    pandas.DataFrame of the results of this run
+    """
+    rev = revision()
+    stamp = pd.Timestamp.now().isoformat(timespec="seconds")
+    rows = []
+    for n in catchments:
+        for y in years:
+            for ns in NS:
+                for name,function,series in benchmarks(n,y,ns):
+                    if only is not None and name not in only:
+                        continue
+                    # benchmarks without resampling are only run for the first NS
+                    if ns != NS[0] and name not in ("fieldSignDaily","fieldSign"):
+                        continue
+                    seconds, peak = measure(function,repeat=repeat)
+                    rows.append({"timestamp":stamp,"revision":rev,"benchmark":name,"catchments":n,"years":y,
+                                 "NS":ns if name in ("fieldSignDaily","fieldSign") else 0,
+                                 "seconds":seconds,"seriesPerSecond":series/seconds,"peakMB":peak})
+                    print(f"{name:18s} catchments={n:<4d} years={y:<3d} NS={ns:<4d} {seconds:8.3f} s "
+                          f"{series/seconds:12.0f} series/s {peak:8.1f} MB")
+    results = pd.DataFrame(rows)
+    Path(resultFile).parent.mkdir(parents=True,exist_ok=True)
+    results.to_csv(resultFile,mode="a",header=not Path(resultFile).exists(),index=False)
+    compare(results,resultFile)
+    return results
+
+def compare(results,resultFile=RESULTS):
+    """
+    Prints the time of each benchmark relative to the latest run of another revision.
+    """
+    history = pd.read_csv(resultFile)
+    rev = results.revision.iloc[0]
+    other = history[history.revision != rev]
+    if other.empty:
+        return
+    key = ["benchmark","catchments","years","NS"]
+    previous = other[other.timestamp == other.timestamp.max()]
+    merged = results.merge(previous,on=key,suffixes=("","Previous"),how="inner")
+    if merged.empty:
+        return
+    print(f"\nCompared with revision {previous.revision.iloc[0]} (time ratio, >1 is slower):")
+    for row in merged.itertuples():
+        print(f"{row.benchmark:18s} catchments={row.catchments:<4d} years={row.years:<3d} "
+              f"{row.seconds/row.secondsPrevious:6.2f}")
+
+def parser():
+    p = argparse.ArgumentParser(description="Benchmarks of the trend and field significance on synthetic data.")
+    p.add_argument("--catchments",nargs="+",type=int,default=[10,50])
+    p.add_argument("--years",nargs="+",type=int,default=[30,50])
+    p.add_argument("--NS",nargs="+",type=int,default=[50])
+    p.add_argument("--only",nargs="+",help="names of the benchmarks to run")
+    p.add_argument("--repeat",type=int,default=1,help="timed runs of each benchmark, the best is kept")
+    p.add_argument("--resultFile",default=RESULTS)
+    return p
+
+if __name__ == "__main__":
+    args = parser().parse_args()
+    run(catchments=args.catchments,years=args.years,NS=args.NS,only=args.only,
+        repeat=args.repeat,resultFile=args.resultFile)
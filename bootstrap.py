@@ -0,0 +1,276 @@
+"""
+    Resampling tables for the field significance bootstrap after Burn and Hag Elnur, 2002.
+
+    All resampled years are drawn up front as one integer table from a seeded
+    numpy.random.Generator, so that a bootstrap run is reproducible.
+    """
+
+import numpy as np
+from contextlib import nullcontext
+from scipy.stats import beta
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from multiprocessing import shared_memory
+import batchTrend
+import kernels
+
+def resamplingTable(NS,days,years,seed=None):
+    """
+    Draws the year indices of all bootstrap samples.
+
+    Parameters
+    ----------
+    NS: int
+        number of bootstrap samples
+    days: int
+        number of DOYs, each DOY is resampled independently
+    years: int
+        number of years in the series
+    seed: int, numpy.random.Generator or None
+        seed of the random generator
+
+    Returns
+    -------
+    numpy array of year indices, shape: (NS,days,years)
+    """
+    rng = np.random.default_rng(seed)
+    return rng.integers(0,years,size=(NS,days,years),dtype=np.int32)
+
+def applyTable(array,index):
+    """
+    Resamples the years of an array with one sample of a resampling table.
+
+    Parameters
+    ----------
+    array: 3D numpy array in the shape (DOY,years,catchments)
+    index: numpy array of year indices, shape: (DOY,years)
+
+    Returns
+    -------
+    resampled array of the same shape
+    """
+    days = np.arange(array.shape[0])[:,None]
+    return array[days,index,:]
+
+def _bootstrapWorker(arraySpec,tableSpec,start,stop,alpha,pvalues=False,masked=True):
+    """
+    Evaluates the bootstrap samples start to stop from arrays in shared memory.
+    """
+    arrayShm = shared_memory.SharedMemory(name=arraySpec[0])
+    tableShm = shared_memory.SharedMemory(name=tableSpec[0])
+    array = np.ndarray(arraySpec[1],dtype=np.dtype(arraySpec[2]),buffer=arrayShm.buf)
+    table = np.ndarray(tableSpec[1],dtype=np.dtype(tableSpec[2]),buffer=tableShm.buf)
+    if pvalues:
+        result = bootstrapPValues(array,table[start:stop],masked=masked)
+    else:
+        result = bootstrapSignificance(array,table[start:stop],alpha=alpha)
+    # views must be released before the blocks can be closed
+    del array, table
+    arrayShm.close()
+    tableShm.close()
+    return result
+
+class Pool:
+    """
+    Process pool for the bootstrap, with shared memory blocks for the array and
+    the resampling table.
+
+    The processes and the shared memory are created once, e.g. per file in
+    dailyFieldSignificance.fieldSignDaily, and reused for every chunk of DOYs and
+    every adaptive batch; each call only copies its array and table into the
+    blocks. The blocks are sized for the largest array and table of the calls.
+
+    The processes are started with "spawn" rather than forked, as a process that
+    has run the threaded numba kernels of kernels.py hangs after forking.
+
+    Parameters
+    ----------
+    workers: int
+        number of processes
+    arrayShape: tuple
+        largest (DOY,years,catchments) array
+    tableShape: tuple
+        largest (NS,DOY,years) table
+    """
+    def __init__(self,workers,arrayShape,tableShape):
+        self.workers = workers
+        self.arrayShm = shared_memory.SharedMemory(create=True,size=max(int(np.prod(arrayShape))*8,1))
+        self.tableShm = shared_memory.SharedMemory(create=True,size=max(int(np.prod(tableShape))*4,1))
+        self.executor = ProcessPoolExecutor(max_workers=workers,mp_context=multiprocessing.get_context("spawn"))
+
+    def _share(self,shm,array,dtype):
+        array = np.asarray(array,dtype=dtype)
+        np.ndarray(array.shape,dtype=array.dtype,buffer=shm.buf)[:] = array
+        return (shm.name,array.shape,array.dtype.str)
+
+    def run(self,array,table,alpha=None,pvalues=False,masked=True):
+        """
+        Splits the bootstrap samples of table into contiguous blocks over the processes,
+        see bootstrapSignificance and bootstrapPValues.
+        """
+        NS = table.shape[0]
+        bounds = np.linspace(0,NS,min(self.workers,NS)+1).astype(int)
+        arraySpec = self._share(self.arrayShm,array,np.float64)
+        tableSpec = self._share(self.tableShm,table,np.int32)
+        futures = [self.executor.submit(_bootstrapWorker,arraySpec,tableSpec,start,stop,alpha,pvalues,masked)
+                   for start,stop in zip(bounds[:-1],bounds[1:])]
+        return np.concatenate([f.result() for f in futures])
+
+    def close(self):
+        self.executor.shutdown()
+        for shm in (self.arrayShm,self.tableShm):
+            shm.close()
+            shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+def openPool(workers,arrayShape,tableShape,backend="numpy"):
+    """
+    Pool for workers>1 with the "numpy" backend, else an empty context, for
+    with openPool(...) as pool: bootstrapSignificance(...,pool=pool).
+    """
+    if workers > 1 and kernels.resolve(backend) == "numpy":
+        return Pool(workers,arrayShape,tableShape)
+    return nullcontext()
+
+def _pool(array,table,workers,alpha=None,pvalues=False,masked=True):
+    """
+    Evaluates the bootstrap samples in a process pool for this call only.
+    """
+    with Pool(workers,array.shape,table.shape) as pool:
+        return pool.run(array,table,alpha=alpha,pvalues=pvalues,masked=masked)
+
+def _samplePValues(array,table,masked=True):
+    """
+    Yields the Mann-Kendall p-values of each bootstrap sample, shape (DOY,catchments),
+    if masked NaN for DOYs where the resampled series of the first catchment contains missing values.
+    """
+    days = np.arange(array.shape[0])
+    finite = np.isfinite(array[:,:,0])
+    # ranks are computed once, in (years,DOY,catchments) layout
+    ranks = np.ascontiguousarray(np.moveaxis(batchTrend.rankSeries(array),1,0))
+    for i in range(table.shape[0]):
+        resampled = ranks[table[i].T,days[None,:],:]
+        p = batchTrend.mannKendallRanks(resampled,axis=0)[0]
+        if masked:
+            p[~finite[days[:,None],table[i]].all(axis=1)] = np.nan
+        yield p
+
+def bootstrapSignificance(array,table,alpha=0.1,workers=1,backend="numpy",pool=None):
+    """
+    Proportion of catchments with a significant trend for each bootstrap sample.
+
+    The series are ranked once and every sample is evaluated on resampled ranks
+    with batchTrend.mannKendallRanks, one sample at a time, so only one resampled
+    copy of the ranks is held in memory per process. With workers>1 the samples are split
+    into contiguous blocks over a process pool; the array and the resampling
+    table are placed in shared memory instead of being pickled for each task.
+    A Pool passed as pool is used instead of starting one for this call.
+    Since every sample is defined by the table, the result does not depend on
+    the number of workers.
+
+    With backend="numba" the samples are evaluated by the compiled kernel of
+    kernels.py in threads of this process instead, and workers is ignored.
+
+    Parameters
+    ----------
+    array: 3D numpy array in the shape (DOY,years,catchments)
+    table: numpy array of year indices, shape: (NS,DOY,years)
+    alpha: float
+    workers: int
+        number of processes
+    backend: str
+        {"numpy","numba","auto"}
+    pool: Pool or None
+        process pool of the "numpy" backend, see openPool
+
+    Returns
+    -------
+    numpy array of shape (NS,DOY), NaN for days where the resampled series of
+    the first catchment contains missing values
+    """
+    if kernels.resolve(backend) == "numba":
+        return kernels.bootstrapSignificance(array,table,alpha=alpha)
+    if pool is not None:
+        return pool.run(array,table,alpha=alpha)
+    if workers > 1:
+        return _pool(array,table,workers,alpha=alpha)
+    distribution = np.full(table.shape[:2],np.nan)
+    for i,p in enumerate(_samplePValues(array,table)):
+        distribution[i] = np.where(np.isnan(p[:,0]),np.nan,(p<alpha).sum(axis=1)/array.shape[2])
+    return distribution
+
+def bootstrapPValues(array,table,workers=1,backend="numpy",pool=None,masked=True):
+    """
+    Mann-Kendall p-values of every catchment in every bootstrap sample.
+
+    Unlike bootstrapSignificance the result does not depend on a significance
+    level, so the distribution for any alpha can be derived from it later with
+    significance.fieldSignificance.
+
+    Parameters
+    ----------
+    array: 3D numpy array in the shape (DOY,years,catchments)
+    table: numpy array of year indices, shape: (NS,DOY,years)
+    workers: int
+        number of processes
+    backend: str
+        {"numpy","numba","auto"}
+    pool: Pool or None
+        process pool of the "numpy" backend, see openPool
+    masked: bool
+        set the p-values of days where the resampled series of the first catchment
+        contains missing values to NaN, else every series is tested on its available years
+
+    Returns
+    -------
+    float32 numpy array of shape (NS,DOY,catchments), if masked NaN for days where the
+    resampled series of the first catchment contains missing values
+    """
+    if kernels.resolve(backend) == "numba":
+        return kernels.bootstrapPValues(array,table,masked=masked)
+    if pool is not None:
+        return pool.run(array,table,pvalues=True,masked=masked)
+    if workers > 1:
+        return _pool(array,table,workers,pvalues=True,masked=masked)
+    out = np.empty(table.shape[:2]+(array.shape[2],),dtype=np.float32)
+    for i,p in enumerate(_samplePValues(array,table,masked=masked)):
+        out[i] = p
+    return out
+
+def decisive(distribution,observed,q=90,confidence=0.99):
+    """
+    Checks if more bootstrap samples can change the field significance.
+
+    The observed proportion is field significant if it is above the q-th
+    percentile of the bootstrap distribution, i.e. if more than q% of the samples
+    are below it. A Clopper-Pearson interval for that fraction, from the samples
+    drawn so far, decides when it lies entirely above or below q%.
+
+    Parameters
+    ----------
+    distribution: numpy.array
+        samples drawn so far along the first axis, NaN for invalid samples
+    observed: numpy.array
+        observed proportion, shape of distribution without the first axis
+    q: float
+        percentile used as critical value
+    confidence: float
+        confidence level of the interval
+
+    Returns
+    -------
+    numpy.array of bool, True where the decision is made; series with invalid
+    samples are decided, as their critical value is NaN
+    """
+    m = distribution.shape[0]
+    k = (distribution < observed).sum(axis=0)
+    a = 1 - confidence
+    with np.errstate(invalid="ignore"):
+        lower = np.where(k>0,beta.ppf(a/2,k,m-k+1),0.)
+        upper = np.where(k<m,beta.ppf(1-a/2,k+1,m-k),1.)
+    return (lower > q/100) | (upper < q/100) | np.isnan(distribution).any(axis=0)
@@ -0,0 +1,129 @@
+"""
+    Compact reshaped arrays: float32 values with a packed validity mask.
+
+    A compact cube stores the (doy,year,catchment) values as float32, with NaN
+    wherever there is no data, and a separate mask of the years each catchment
+    has data for, packed to bits along the year axis. Catchments missing from a
+    period (filled with -99 in the float64 arrays) are found from the mask
+    instead of scanning the whole array for the fill value.
+
+    The mask of Reshaped/x.npy is saved to Reshaped/valid/x.npy, so that the
+    folder listings of dailyFieldSignificance.findFiles are unchanged. Arrays
+    without a mask file are read as before.
+    """
+
+import numpy as np
+from pathlib import Path
+
+def validity(array,fill=-99):
+    """
+    Years with data of each catchment.
+
+    Parameters
+    ----------
+    array: numpy.array
+        array of shape (doy,year,catchment), missing values NaN or fill
+
+    Returns
+    -------
+    numpy.array of bool, shape (catchment,year)
+    """
+    array = np.asarray(array)
+    return (np.isfinite(array) & (array != fill)).any(axis=0).T
+
+def pack(valid):
+    """
+    Packs a (catchment,year) validity mask to bits along the year axis.
+    """
+    return np.packbits(valid,axis=-1)
+
+def unpack(packed,years):
+    """
+    Unpacks a validity mask packed with pack.
+    """
+    return np.unpackbits(packed,axis=-1,count=years).astype(bool)
+
+def selectionMask(catchments,available,years):
+    """
+    Validity mask of a selection of catchments, built without reading the array.
+
+    The catchments in available are valid in all years, years without data stay
+    NaN in the array; the other catchments are missing from the period.
+
+    Parameters
+    ----------
+    catchments: list
+        selected catchments, in the order of the array
+    available: list
+        catchments in the data
+    years: int
+        number of years in the array
+
+    Returns
+    -------
+    numpy.array of bool, shape (catchment,year)
+    """
+    available = set(available)
+    present = np.array([c in available for c in catchments],dtype=bool)
+    return np.repeat(present[:,None],int(years),axis=1)
+
+def compress(array,fill=-99):
+    """
+    Converts an array with fill for missing catchments to a compact cube.
+
+    Returns
+    -------
+    tuple
+        float32 array with NaN for missing values, and the validity mask of shape (catchment,year)
+    """
+    valid = validity(array,fill=fill)
+    values = np.asarray(array,dtype=np.float32)
+    if fill is not None:
+        values = np.where(values==fill,np.float32(np.nan),values)
+    return values, valid
+
+def missing(array,valid=None,fill=-99):
+    """
+    Catchments without any data, from the validity mask if given, else by scanning
+    the array for catchments filled with fill.
+    """
+    if valid is not None:
+        return ~valid.any(axis=1)
+    return (np.asarray(array)==fill).all(axis=(0,1))
+
+def maskFile(file):
+    file = Path(file)
+    return file.parent/"valid"/file.name
+
+def save(file,array,valid):
+    """
+    Saves a compact cube to file and its packed validity mask to valid/ next to it.
+    """
+    np.save(file,np.asarray(array,dtype=np.float32))
+    mask = maskFile(f"{file}.npy" if not str(file).endswith(".npy") else file)
+    mask.parent.mkdir(parents=True,exist_ok=True)
+    np.save(mask,pack(valid))
+
+def saveMask(file,valid):
+    """
+    Saves the validity mask of an array already written to file.
+    """
+    mask = maskFile(file)
+    mask.parent.mkdir(parents=True,exist_ok=True)
+    np.save(mask,pack(valid))
+
+def load(file,mmap_mode="r"):
+    """
+    Opens a reshaped array and its validity mask.
+
+    Returns
+    -------
+    tuple
+        array, memory-mapped by default, and the validity mask of shape
+        (catchment,year), None for arrays saved without a mask
+    """
+    array = np.load(file,mmap_mode=mmap_mode)
+    mask = maskFile(file)
+    if not mask.exists():
+        return array, None
+    return array, unpack(np.load(mask),array.shape[1])
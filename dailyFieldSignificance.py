@@ -5,9 +5,19 @@
 import numpy as np
 import pandas as pd
 import datetime
+import os
+import inspect
 import pickle
 from trendmaster import trend
 from pathlib import Path
+from reshapeToArray import regionCube
+import batchTrend
+import bootstrap
+import resultCache
+import kernels
+import significance
+import compactCube
+from instrumentation import peakRSS, stage, Progress
 
 def findFiles(variable="_",region="_",MA="day",years="year",resultDir="Reshaped"):
     """
@@ -32,113 +42,445 @@ def findFiles(variable="_",region="_",MA="day",years="year",resultDir="Reshaped"
     
     return files
 
-def resamplingDaily(array):
+def resamplingDaily(array, seed = None):
     """
         Resampling procedure after Burn and Hag Elnur, 2002.
         
         Parameters
         ----------
         array: 3D numpy array in the shape (DOY,years,catchments)
-        years: int
-        MA: str
+        seed: int or None
+            seed of the random generator
         
         Returns
         -------
-        dataframe with resampled data
+        3D numpy array with resampled data
         """
-    years = np.arange(0,array.shape[1])
-    days = np.arange(0,array.shape[0])
-    resampled = np.full_like(array,np.nan)
-    for DOY in days:
-        for i in range(len(years)):
-            # select random year
-            year = np.random.choice(years)
-            # get values for that year
-            resampled[DOY,i,:] = array[DOY,year,:]
+    index = bootstrap.resamplingTable(1,array.shape[0],array.shape[1],seed=seed)[0]
+    return bootstrap.applyTable(array,index)
 
-    return resampled
+def pValues(array, backend = "numpy"):
+    """
+    Mann-Kendall p-values of every catchment for each DOY.
+    
+    Parameters
+    ----------
+    array: 3D numpy array in the shape (DOY,years,catchments)
+    backend: str
+        {"numpy","numba","trend","auto"}, "numpy" tests all series in one call, "numba" runs the
+        compiled kernel of kernels.py, "trend" calls trend.mann_kendall per series
+    
+    Returns
+    -------
+    numpy array of shape (DOY,catchments)
+    """
+    backend = kernels.resolve(backend)
+    if backend == "numpy":
+        return batchTrend.mannKendall(array)[0]
+    elif backend == "numba":
+        return kernels.mannKendall(array)[0]
+    elif backend == "trend":
+        p = np.empty((array.shape[0],array.shape[2]))
+        for d in range(array.shape[0]):
+            for c in range(array.shape[2]):
+                p[d,c] = trend.mann_kendall(array[d,:,c])
+        return p
+    else:
+        raise ValueError(f"Unknown backend: {backend}")
+
+def countSignificant(array, alpha = 0.1, backend = "numpy"):
+    """
+    Counts the catchments with a significant Mann-Kendall trend for each DOY.
+    
+    Parameters
+    ----------
+    array: 3D numpy array in the shape (DOY,years,catchments)
+    alpha: float
+    backend: str
+        {"numpy","numba","trend","auto"}, see pValues
+    
+    Returns
+    -------
+    numpy array of number of significant catchments per DOY
+    """
+    return (pValues(array,backend=backend)<alpha).sum(axis=1)
 
-def fieldSignDaily(array, alpha = 0.1, q = 90, NS = 400):
+def loadBlock(array, start, stop, missing = None):
+    """
+    Reads the DOYs start to stop of an array as float64.
+    
+    Catchments without data in a compact cube (missing, see compactCube.py) are
+    set to a constant series, like the -99 fill of the other arrays, so that they
+    count as catchments without a significant trend.
+    """
+    with stage("load"):
+        if missing is None or not missing.any():
+            return np.asarray(array[start:stop],dtype=float)
+        block = np.array(array[start:stop],dtype=float)
+        block[:,:,missing] = 0
+        return block
+
+def openPool(array, NS, step, workers = 1, backend = "numpy"):
+    """
+    Process pool of the bootstrap for an array analysed step DOYs at a time,
+    started once per array, see bootstrap.Pool.
+    """
+    days = min(step,array.shape[0])
+    return bootstrap.openPool(workers,(days,)+array.shape[1:],(NS,days,array.shape[1]),backend=backend)
+
+def fieldSignDaily(array, alpha = 0.1, q = 90, NS = 400, backend = "numpy", seed = None, workers = 1, chunk = None,
+                   adaptive = False, batch = 50, confidence = 0.99, valid = None, method = "bootstrap"):
     """
     Calculating the field significance after Burn and Hag Elnur, 2002.
+    
+    The resampled years of all NS iterations are drawn up front from a generator
+    seeded with seed, so that results are reproducible. With the "numpy" backend
+    the iterations are spread over workers processes, with identical results
+    for any number of workers.
+    
+    Each DOY is resampled and tested independently, so the "numpy" backend can
+    read and analyse the array chunk DOYs at a time. This keeps memory use low
+    for memory-mapped arrays (np.load(file,mmap_mode="r")), with results
+    identical to analysing all DOYs at once.
+    
+    The worker processes and their shared memory are started once per array
+    and reused for every chunk and every adaptive batch.
+    
+    The "numba" backend works as the "numpy" backend with the compiled kernels of
+    kernels.py, in threads instead of worker processes.
+    
+    With adaptive=True ("numpy" and "numba" backends) the samples are drawn batch at a time, and
+    a DOY stops once bootstrap.decisive finds its field significance decided at the
+    given confidence; only borderline DOYs use all NS samples. The critical value
+    of each DOY is the percentile of the samples it used, which are the first
+    samples of the fixed-NS run with the same seed. The number of samples used is
+    returned in the column "resamples".
+    
+    For a compact cube (see compactCube.py) valid is its validity mask, and
+    catchments without data are found from it instead of from the -99 fill.
+    
+    With method "fdr" (Benjamini-Hochberg false discovery rate) or "walker"
+    (Walker's test) the field significance is tested from the p-values of the
+    observed series alone, without resampling, at the global level 1-q/100, see
+    significance.analyticFieldSignificance. pcrit is then the critical p-value
+    of the test instead of a critical proportion of catchments, and catchments
+    without data are left out of the test.
     """
+    if method not in significance.METHODS:
+        raise ValueError(f"Unknown method: {method}")
+    missing = None if valid is None else compactCube.missing(array,valid)
+    if method != "bootstrap":
+        pvalue = np.full((array.shape[0],array.shape[2]),np.nan)
+        filled = np.ones(array.shape[2],dtype=bool)
+        step = array.shape[0] if chunk is None else chunk
+        for d in range(0,array.shape[0],step):
+            block = loadBlock(array,d,d+step,missing)
+            pvalue[d:d+step] = pValues(block,backend=backend)
+            filled &= (block==-99).all(axis=(0,1))
+        pvalue[:,filled if missing is None else missing] = np.nan
+        pcrit, percentSign, significant = significance.analyticFieldSignificance(pvalue,alpha=alpha,q=q,method=method)
+        return pd.DataFrame({"pcrit":pcrit,"percentSign":percentSign,"fieldSignificant":significant})
     days = np.arange(0,array.shape[0])
+    table = bootstrap.resamplingTable(NS,array.shape[0],array.shape[1],seed=seed)
     
-    significant = []
-    print("Iternation number:")
-    for i in range(NS):
-        if i in np.arange(0,400,50):
-            print(i,"of 400")
-        resampledArray = resamplingDaily(array)
-        sign = np.full(resampledArray.shape[0],np.nan)
-        for d in days:
-            if np.isfinite(resampledArray[d,:,0]).all():
-                s = 0
-                for c in range(resampledArray.shape[2]):
-                    p = trend.mann_kendall(resampledArray[d,:,c])
-                    if p<alpha:
-                        s += 1
-                # proportion of catchments with signifcant trend
-                sign[d] = s/resampledArray.shape[2]
-        significant.append(sign)
-    
-    distribution = np.array(significant)
+    backend = kernels.resolve(backend)
+    if backend in ("numpy","numba"):
+        distribution = np.full((NS,array.shape[0]),np.nan)
+        percentSign = np.full(array.shape[0],np.nan)
+        resamples = np.full(array.shape[0],NS)
+        step = array.shape[0] if chunk is None else chunk
+        progress = Progress(array.shape[0],"DOYs resampled",NS=NS)
+        with openPool(array,NS,step,workers,backend) as pool:
+            for d in range(0,array.shape[0],step):
+                block = loadBlock(array,d,d+step,missing)
+                percentSign[d:d+step] = countSignificant(block,alpha=alpha,backend=backend)/array.shape[2]
+                if not adaptive:
+                    with stage("resample"):
+                        distribution[:,d:d+step] = bootstrap.bootstrapSignificance(block,table[:,d:d+step],alpha=alpha,workers=workers,
+                                                                                   backend=backend,pool=pool)
+                    progress.update(block.shape[0])
+                    continue
+                # DOYs still undecided, as positions in the array
+                active = np.arange(d,d+block.shape[0])
+                used = 0
+                while len(active) > 0 and used < NS:
+                    stop = min(used+batch,NS)
+                    with stage("resample"):
+                        distribution[used:stop,active] = bootstrap.bootstrapSignificance(block[active-d],table[used:stop,active],
+                                                                                       alpha=alpha,workers=workers,backend=backend,pool=pool)
+                    used = stop
+                    resamples[active] = used
+                    active = active[~bootstrap.decisive(distribution[:used,active],percentSign[active],q=q,confidence=confidence)]
+                progress.update(block.shape[0])
+    else:
+        if adaptive:
+            raise ValueError("adaptive resampling needs the numpy or numba backend")
+        if missing is not None:
+            array = loadBlock(array,0,array.shape[0],missing)
+        resamples = np.full(array.shape[0],NS)
+        significant = []
+        progress = Progress(NS,"bootstrap iterations")
+        for i in range(NS):
+            resampledArray = bootstrap.applyTable(array,table[i])
+            # proportion of catchments with signifcant trend
+            sign = countSignificant(resampledArray,alpha=alpha,backend=backend)/resampledArray.shape[2]
+            sign[~np.isfinite(resampledArray[:,:,0]).all(axis=1)] = np.nan
+            significant.append(sign)
+            progress.update()
+        distribution = np.array(significant)
+        percentSign = countSignificant(array,alpha=alpha,backend=backend)/array.shape[2]
     
     pcrit = []
     for d in days:
-        if np.isfinite(distribution[:,d]).all():
-            pcrit.append(np.percentile(distribution[:,d],q))
+        if np.isfinite(distribution[:resamples[d],d]).all():
+            pcrit.append(np.percentile(distribution[:resamples[d],d],q))
         else:
             pcrit.append(np.nan)
     pcrit = np.array(pcrit)
     
-    percentSign = []
-    for d in days:
-        s = 0
-        for c in range(array.shape[2]):
-            p = trend.mann_kendall(array[d,:,c])
-            if p<alpha:
-                s += 1
-        percentSign.append(s/array.shape[2])
-    percentSign = np.array(percentSign)
-    
     output = {"pcrit":pcrit,"percentSign":percentSign,"fieldSignificant":percentSign>pcrit}
+    if adaptive:
+        output["resamples"] = resamples
     return pd.DataFrame(output)
 
-variable = input("\n\n-----\nIf selecting files by VARIABLE please enter 'streamflow','rainfall' or 'snowmelt', else press Enter\n")
-region = input("\nIf selecting files by REGION please enter shortend name of region,e.g. 'ost' etc, else press Enter\n")
-MA = input("\nIf selecting files by MA smoothing please enter shortend window size,e.g. '5', else press Enter\n")
-period = input("\nIf selecting files by period please enter number of years,e.g. '30', else press Enter\n")
-
+def fieldSignRecord(array, NS = 400, seed = None, workers = 1, chunk = None, backend = "numpy", valid = None):
+    """
+    Mann-Kendall p-values of the observed series and of all bootstrap samples.
+    
+    The samples are the same as in fieldSignDaily with the same seed and NS, and
+    the record does not depend on alpha or q: significance.fieldSignificance
+    derives the result of fieldSignDaily for any of them. The bootstrap p-values
+    are stored as float32.
+    
+    Parameters
+    ----------
+    array: 3D numpy array in the shape (DOY,years,catchments), may be memory-mapped
+    NS: int
+    seed: int or None
+    workers: int
+    chunk: int
+        number of DOYs read and analysed at a time, default is all DOYs
+    backend: str
+        {"numpy","numba","auto"}
+    valid: numpy array
+        validity mask of a compact cube, see compactCube.py
+    
+    Returns
+    -------
+    dictionary with "pvalue", shape: (DOY,catchments), and "bootstrap", shape: (NS,DOY,catchments)
+    """
+    backend = kernels.resolve(backend)
+    if backend not in ("numpy","numba"):
+        raise ValueError("fieldSignRecord needs the numpy or numba backend")
+    missing = None if valid is None else compactCube.missing(array,valid)
+    table = bootstrap.resamplingTable(NS,array.shape[0],array.shape[1],seed=seed)
+    pvalue = np.full((array.shape[0],array.shape[2]),np.nan)
+    samples = np.full((NS,array.shape[0],array.shape[2]),np.nan,dtype=np.float32)
+    step = array.shape[0] if chunk is None else chunk
+    progress = Progress(array.shape[0],"DOYs resampled",NS=NS)
+    with openPool(array,NS,step,workers,backend) as pool:
+        for d in range(0,array.shape[0],step):
+            block = loadBlock(array,d,d+step,missing)
+            mk = kernels.mannKendall if backend == "numba" else batchTrend.mannKendall
+            pvalue[d:d+step] = mk(block)[0]
+            with stage("resample"):
+                samples[:,d:d+step] = bootstrap.bootstrapPValues(block,table[:,d:d+step],workers=workers,backend=backend,pool=pool)
+            progress.update(block.shape[0])
+    return {"pvalue":pvalue,"bootstrap":samples}
 
-if variable == "":
-    variable="_"
-if region == "":
-    region="_"
-if MA == "":
-    MA="day"
-if period == "":
-    period = "year"
+def fieldSignGroups(array, groups, alpha = 0.1, q = 90, NS = 400, seed = None, workers = 1, chunk = None,
+                    backend = "numpy", national = "norway", valid = None):
+    """
+    Field significance of several regions and of all their catchments together,
+    from one cube and one set of bootstrap samples.
+    
+    The p-values of all catchments are computed once per sample and reduced to
+    the proportion of significant catchments of each region and of the whole
+    cube. The samples depend only on seed, NS and the shape of the DOY and year
+    axes, so each region gets the result of fieldSignDaily on its own array with
+    the same seed: a sample of a DOY is invalid for a region where the first
+    catchment of the region has missing values in the resampled years.
+    
+    Parameters
+    ----------
+    array: 3D numpy array in the shape (DOY,years,catchments), may be memory-mapped
+    groups: numpy array
+        region of each catchment, see reshapeToArray.regionCube
+    alpha, q, NS, seed, workers, chunk, backend:
+        as for fieldSignDaily and fieldSignRecord
+    national: str
+        name of the group of all catchments
+    valid: numpy array
+        validity mask of a compact cube, see compactCube.py
+    
+    Returns
+    -------
+    dictionary of pandas.DataFrame by region and national, as returned by fieldSignDaily
+    """
+    groups = np.asarray(groups)
+    labels = list(dict.fromkeys(groups))
+    # catchment to group matrix, the last group holds all catchments
+    members = np.column_stack([groups == g for g in labels] + [np.ones(len(groups),dtype=bool)]).astype(float)
+    size = members.sum(axis=0)
+    # first catchment of each group, which decides if a sample is valid
+    first = members.argmax(axis=0)
+    backend = kernels.resolve(backend)
+    if backend not in ("numpy","numba"):
+        raise ValueError("fieldSignGroups needs the numpy or numba backend")
+    missing = None if valid is None else compactCube.missing(array,valid)
+    mk = kernels.mannKendall if backend == "numba" else batchTrend.mannKendall
+    table = bootstrap.resamplingTable(NS,array.shape[0],array.shape[1],seed=seed)
+    percentSign = np.full((array.shape[0],len(size)),np.nan)
+    distribution = np.full((NS,array.shape[0],len(size)),np.nan)
+    step = array.shape[0] if chunk is None else chunk
+    progress = Progress(array.shape[0],"DOYs resampled",NS=NS)
+    with openPool(array,NS,step,workers,backend) as pool:
+        for d in range(0,array.shape[0],step):
+            block = loadBlock(array,d,d+step,missing)
+            percentSign[d:d+step] = ((mk(block)[0]<alpha) @ members)/size
+            with stage("resample"):
+                p = bootstrap.bootstrapPValues(block,table[:,d:d+step],workers=workers,backend=backend,pool=pool,masked=False)
+                counts = np.einsum("idc,cg->idg",(p<alpha).astype(float),members)
+                # (NS,DOY,groups), True where the resampled years of the first catchment are complete
+                finite = np.isfinite(block[:,:,first])
+                complete = finite[np.arange(block.shape[0])[None,:,None],table[:,d:d+step]].all(axis=2)
+                distribution[:,d:d+step] = np.where(complete,counts/size,np.nan)
+            progress.update(block.shape[0])
+    # NaN for DOYs with invalid samples
+    pcrit = np.percentile(distribution,q,axis=0)
+    return {g:pd.DataFrame({"pcrit":pcrit[:,i],"percentSign":percentSign[:,i],"fieldSignificant":percentSign[:,i]>pcrit[:,i]})
+            for i,g in enumerate(labels+[national])}
 
-files = findFiles(variable=variable,region=region,MA=MA,years=period)
-print("\n---------------------------------")
-print(f"Analysing {len(files)} files.")
-for file in files:
-    print(file)
-print("---------------------------------\n")
+def fieldSignNational(variable, period, regions, averages = ["5day","10day","30day"], reshapedDir = "Reshaped",
+                      resultDir = "Results/FS", seed = 0, workers = 1, chunk = 30, cacheDir = resultCache.CACHE,
+                      national = "norway", **kwargs):
+    """
+    Calculates the field significance of all regions from one cube per MA, see fieldSignGroups,
+    and saves the result of each region and of all catchments to the .csv files
+    written by fieldSignFiles, with national in place of the region for all catchments.
+    
+    Parameters
+    ----------
+    variable: str
+    period: int
+        number of years in period
+    regions: list
+        regions joined in the cube, regions without a reshaped array are left out
+    averages: list
+    reshapedDir: str
+        folder of the reshaped arrays
+    resultDir, seed, workers, chunk, cacheDir:
+        as for fieldSignFiles
+    national: str
+    kwargs:
+        further arguments to fieldSignGroups, e.g. alpha, q, NS, backend
+    """
+    params = {k:v.default for k,v in inspect.signature(fieldSignGroups).parameters.items() if k in ("alpha","q","NS","backend")}
+    params.update({k:v for k,v in kwargs.items() if k in params})
+    params["backend"] = kernels.resolve(params["backend"])
+    for MA in averages:
+        files = {region:f"{reshapedDir}/{variable}_{region}_{MA}_{period}year.npy" for region in regions}
+        loaded = {region:compactCube.load(file) for region,file in files.items() if Path(file).exists()}
+        if not loaded:
+            continue
+        arrays = {region:a for region,(a,v) in loaded.items()}
+        valid = None
+        if any(v is not None for a,v in loaded.values()):
+            valid = np.concatenate([compactCube.validity(a) if v is None else v for a,v in loaded.values()])
+        print(f"{variable} {MA} {period} years, {len(arrays)} regions calculating...")
+        with stage("load"):
+            cube, labels = regionCube(arrays)
+        results = resultCache.cached(cube,lambda: fieldSignGroups(cube,labels,seed=seed,workers=workers,chunk=chunk,
+                                                                  national=national,valid=valid,**kwargs),
+                                     label=f"fieldSignificance_{variable}_{national}_{MA}_{period}year",root=cacheDir,valid=valid,
+                                     stage="fieldSignGroups",seed=seed,regions=list(arrays),**params)
+        with stage("write"):
+            for region,result in results.items():
+                result.to_csv(f"{resultDir}/fieldSignificance_{variable}_{region}_{MA}_{period}year.csv")
+        print(f"Peak memory use: {peakRSS():.0f} MB\n")
 
-for file in files:
-    var,region,MA,period = tuple(file.split("/")[-1].split(".")[0].split("_"))
-    # checking if file already exists
-    exists = findFiles(variable=var,region=region,MA=MA,years=period,resultDir="Results/FS")
-    if len(exists)>0:
-        print("-----","\nFile already exists in Results/FS directroy","\nField significance not calculated for",file,"\n-----")
-        continue
-    else:
+def fieldSignFiles(files, resultDir = "Results/FS", seed = 0, workers = 1, chunk = 30, cacheDir = resultCache.CACHE,
+                   record = False, **kwargs):
+    """
+    Calculates the field significance of reshaped arrays and saves each result to a .csv file.
+    
+    Results are cached by the content of the array and all parameters, so an array
+    is only analysed again if it or alpha, q, NS, seed, method or backend changed. The
+    results of method "fdr" and "walker" are saved with the method appended to
+    the name, next to the bootstrap results.
+    
+    Parameters
+    ----------
+    files: list
+        .npy-files named variable_region_MA_period
+    resultDir: str
+    seed: int
+    workers: int
+    chunk: int
+        number of DOYs read from the memory-mapped array at a time
+    cacheDir: str
+        result cache, None to always calculate
+    record: bool
+        also save the p-values of all samples to fieldSignRecord_variable_region_MA_period.npz,
+        see fieldSignRecord; the .csv is then derived from the record
+    kwargs:
+        further arguments to fieldSignDaily, e.g. alpha, q, NS, adaptive, method
+    """
+    # parameters that change the result, with the defaults of fieldSignDaily
+    params = {k:v.default for k,v in inspect.signature(fieldSignDaily).parameters.items()
+              if k in ("alpha","q","NS","adaptive","batch","confidence","method","backend")}
+    params.update({k:v for k,v in kwargs.items() if k in params})
+    params["backend"] = kernels.resolve(params["backend"])
+    if record and params["method"] != "bootstrap":
+        raise ValueError("a record holds bootstrap samples, it needs the bootstrap method")
+    for file in files:
+        var,region,MA,period = tuple(file.split("/")[-1].split(".")[0].split("_"))
+        name = f"fieldSignificance_{var}_{region}_{MA}_{period}"
+        if params["method"] != "bootstrap":
+            name += f"_{params['method']}"
         print(file,"calculating...")
-    # opening array file
-    array = np.load(file)
-    # calculating field significance
-    result = fieldSignDaily(array)
-    result.to_csv(f"Results/FS/fieldSignificance_{var}_{region}_{MA}_{period}.csv")
-    print(var,region,MA,period,"finished.\n")
+        # opening array file without reading it into memory
+        array, valid = compactCube.load(file)
+        # calculating field significance, chunk DOYs at a time
+        if record:
+            if params["adaptive"]:
+                raise ValueError("a record needs all NS samples, it cannot be adaptive")
+            rec = resultCache.cached(array,lambda: fieldSignRecord(array,NS=params["NS"],seed=seed,workers=workers,chunk=chunk,
+                                                                   backend=params["backend"],valid=valid),
+                                     label=f"fieldSignRecord_{var}_{region}_{MA}_{period}",root=cacheDir,valid=valid,
+                                     stage="fieldSignRecord",seed=seed,NS=params["NS"],backend=params["backend"])
+            result = significance.fieldSignificance(rec["pvalue"],rec["bootstrap"],alpha=params["alpha"],q=params["q"])
+        else:
+            result = resultCache.cached(array,lambda: fieldSignDaily(array,seed=seed,workers=workers,chunk=chunk,valid=valid,**kwargs),
+                                        label=name,root=cacheDir,valid=valid,stage="fieldSignDaily",seed=seed,**params)
+        with stage("write"):
+            result.to_csv(f"{resultDir}/{name}.csv")
+            if record:
+                np.savez(f"{resultDir}/fieldSignRecord_{var}_{region}_{MA}_{period}",**rec)
+        print(var,region,MA,period,"finished.")
+        print(f"Peak memory use: {peakRSS():.0f} MB\n")
+
+if __name__ == "__main__":
+    variable = input("\n\n-----\nIf selecting files by VARIABLE please enter 'streamflow','rainfall' or 'snowmelt', else press Enter\n")
+    region = input("\nIf selecting files by REGION please enter shortend name of region,e.g. 'ost' etc, else press Enter\n")
+    MA = input("\nIf selecting files by MA smoothing please enter shortend window size,e.g. '5', else press Enter\n")
+    period = input("\nIf selecting files by period please enter number of years,e.g. '30', else press Enter\n")
+    
+    
+    if variable == "":
+        variable="_"
+    if region == "":
+        region="_"
+    if MA == "":
+        MA="day"
+    if period == "":
+        period = "year"
+    
+    files = findFiles(variable=variable,region=region,MA=MA,years=period)
+    print("\n---------------------------------")
+    print(f"Analysing {len(files)} files.")
+    for file in files:
+        print(file)
+    print("---------------------------------\n")
+    
+    fieldSignFiles(files,workers=os.cpu_count())
@@ -0,0 +1,339 @@
+"""
+    On-disk store of catchment data as arrays instead of pickled dictionaries.
+
+    Layout of the store directory:
+        daily/<region>/<variable>.npy       daily data, shape (day,catchment)
+        daily/<region>/<variable>_present.npy   days of each catchment's own series, bits packed along day
+        daily/<region>/index.json           dates, catchment order, final30/final50 selection
+        daily/<region>/metadata.csv         catchment metadata
+        MA/<variable>/<period>year/<region>/<MA>.npy     moving averages, shape (doy,year,catchment)
+        MA/<variable>/<period>year/<region>/index.json   years and catchments
+
+    Each array is one .npy file per variable, region and moving average, which is
+    opened memory-mapped, so loading one region or variable only reads that part.
+    """
+
+import numpy as np
+import pandas as pd
+import pickle
+import json
+from pathlib import Path
+from collections.abc import Mapping
+from reshapeToArray import catchmentArray
+
+# short region names and the names of the pickled regional dictionaries
+REGIONS = {"sor":"sorlandet",
+           "ost":"ostlandet",
+           "vest":"vestlandet",
+           "trond":"trondelag",
+           "nord":"nordland",
+           "finn":"finnmark"}
+
+# daily variables of the regional dictionaries and their column names
+DAILY = {"runoff":"runoff",
+         "precip":None,
+         "temp":None,
+         "snow":"qsw"}
+
+def _plain(values):
+    """
+    Converts numpy scalars to python types for json.
+    """
+    return [v.item() if isinstance(v,np.generic) else v for v in values]
+
+def _writeIndex(folder,index):
+    folder.mkdir(parents=True,exist_ok=True)
+    with open(folder/"index.json","w") as f:
+        json.dump(index,f)
+
+def _readIndex(folder):
+    with open(folder/"index.json") as f:
+        return json.load(f)
+
+def exists(root="Store"):
+    """
+    Checks if a store has been written to the directory root.
+    """
+    return (Path(root)/"daily").is_dir() or (Path(root)/"MA").is_dir()
+
+def writeRegion(data,region,root="Store"):
+    """
+    Writes the daily data of a regional dictionary (e.g. sorlandet_final.pkl) to the store.
+
+    Parameters
+    ----------
+    data: dictionary
+        organised data for a region with "order", "data", "metadata", "final30" and "final50"
+    region: str
+        short name of region, e.g. "sor"
+    root: str
+        store directory
+    """
+    folder = Path(root)/"daily"/region
+    folder.mkdir(parents=True,exist_ok=True)
+    catchments = list(data["order"])
+    tables = {}
+    indices = {}
+    for var,column in DAILY.items():
+        series = []
+        for c in catchments:
+            ts = data["data"][c][var]
+            if column is not None:
+                ts = ts[column]
+            series.append(ts)
+        tables[var] = pd.concat(series,axis=1,keys=range(len(catchments)))
+        indices[var] = [ts.index for ts in series]
+    # all variables share one continuous daily index, the days of each series are kept as a mask
+    dates = pd.date_range(min(df.index.min() for df in tables.values()),
+                          max(df.index.max() for df in tables.values()))
+    for var,df in tables.items():
+        np.save(folder/f"{var}.npy",np.asarray(df.reindex(dates),dtype=float))
+        present = np.array([dates.isin(index) for index in indices[var]])
+        np.save(folder/f"{var}_present.npy",np.packbits(present,axis=-1))
+    _writeIndex(folder,{"catchments":_plain(catchments),
+                        "start":str(dates[0].date()),
+                        "days":len(dates),
+                        "final30":_plain(data.get("final30",[])),
+                        "final50":_plain(data.get("final50",[]))})
+    data["metadata"].to_csv(folder/"metadata.csv",index=False)
+
+def writeMA(varDict,variable,period,root="Store",dropLeapDay=True):
+    """
+    Writes a moving average dictionary (e.g. MA_rainfall_30year.pkl) to the store.
+
+    Parameters
+    ----------
+    varDict: dictionary
+        moving averages by region, catchment and MA
+    variable: str
+        name of the variable, e.g. "rainfall"
+    period: int
+        number of years in period
+    root: str
+        store directory
+    dropLeapDay: bool
+        see reshapeToArray.dayIndex
+    """
+    for region in varDict.keys():
+        folder = Path(root)/"MA"/variable/f"{period}year"/region
+        catchments = list(varDict[region].keys())
+        averages = list(varDict[region][catchments[0]].keys())
+        first = varDict[region][catchments[0]][averages[0]]
+        years = np.arange(first.index.year.min(),first.index.year.max()+1)
+        folder.mkdir(parents=True,exist_ok=True)
+        for MA in averages:
+            arr = np.full((365,len(years),len(catchments)),np.nan)
+            for c in range(len(catchments)):
+                arr[:,:,c] = catchmentArray(varDict[region][catchments[c]][MA],years,dropLeapDay=dropLeapDay)
+            np.save(folder/f"{MA}.npy",arr)
+        _writeIndex(folder,{"catchments":_plain(catchments),
+                            "years":_plain(years),
+                            "averages":averages})
+
+def appendYear(varDict,variable,period,year,root="Store",dropLeapDay=True):
+    """
+    Appends a new year of moving averages to the stored arrays of a variable,
+    so that periods ending in year can be loaded with loadMA(endYear=year).
+
+    Parameters
+    ----------
+    varDict: dictionary
+        moving averages by region, catchment and MA containing at least the new year
+    variable: str
+    period: int
+        number of years in period of the stored arrays
+    year: int
+        the new year, the year after the last stored year
+    root: str
+        store directory
+    dropLeapDay: bool
+        see reshapeToArray.dayIndex, as when the store was written
+    """
+    for region in varDict.keys():
+        folder = Path(root)/"MA"/variable/f"{period}year"/region
+        index = _readIndex(folder)
+        if year != index["years"][-1]+1:
+            raise ValueError(f"{year} does not follow the last stored year {index['years'][-1]}")
+        for MA in index["averages"]:
+            values = np.full((365,1,len(index["catchments"])),np.nan)
+            for c in range(len(index["catchments"])):
+                if index["catchments"][c] in varDict[region]:
+                    values[:,:,c] = catchmentArray(varDict[region][index["catchments"][c]][MA],np.array([year]),
+                                                   dropLeapDay=dropLeapDay)
+            stored = np.load(folder/f"{MA}.npy")
+            np.save(folder/f"{MA}.npy",np.concatenate((stored,values),axis=1))
+        index["years"].append(int(year))
+        _writeIndex(folder,index)
+
+def regions(variable=None,period=30,root="Store"):
+    """
+    Lists the regions in the store, for the daily data or for a moving average variable.
+    """
+    folder = Path(root)/"daily" if variable is None else Path(root)/"MA"/variable/f"{period}year"
+    return sorted(p.name for p in folder.iterdir() if p.is_dir())
+
+def catchments(variable,region,period=30,root="Store"):
+    """
+    Lists the catchments stored for a moving average variable and region.
+    """
+    return _readIndex(Path(root)/"MA"/variable/f"{period}year"/region)["catchments"]
+
+def loadMA(variable,region,MA,period=30,catchments=None,fill=-99,root="Store",endYear=2012,dtype=float):
+    """
+    Loads the moving average array of one variable, region and MA.
+
+    Only the selected years and catchments are read from the memory-mapped file.
+
+    Parameters
+    ----------
+    variable: str
+    region: str
+    MA: str
+        {"5day","10day","30day"}
+    period: int
+        number of years in period, ending in endYear
+    catchments: list
+        catchments in this order, default is all catchments in the store
+    fill: float
+        value for catchments in the list that are missing in the store
+    root: str
+        store directory
+    endYear: int
+        last year of the period
+    dtype: numpy.dtype
+        dtype of the array, e.g. numpy.float32 for a compact cube
+
+    Returns
+    -------
+    numpy.array
+        array of shape (doy,year,catchment)
+    """
+    folder = Path(root)/"MA"/variable/f"{period}year"/region
+    index = _readIndex(folder)
+    stored = np.load(folder/f"{MA}.npy",mmap_mode="r")
+    start = index["years"].index(endYear+1-int(period))
+    years = slice(start,start+int(period))
+    if catchments is None:
+        catchments = index["catchments"]
+    position = {c:i for i,c in enumerate(index["catchments"])}
+    arr = np.full((365,int(period),len(catchments)),fill,dtype=dtype)
+    for c in range(len(catchments)):
+        if catchments[c] in position:
+            arr[:,:,c] = stored[:,years,position[catchments[c]]]
+    return arr
+
+def loadDaily(region,variable,catchments=None,root="Store"):
+    """
+    Loads daily data of one variable for a region.
+
+    Parameters
+    ----------
+    region: str
+    variable: str
+        {"runoff","precip","temp","snow"}
+    catchments: list
+        catchments to load, default is all catchments of the region
+    root: str
+        store directory
+
+    Returns
+    -------
+    pandas.DataFrame
+        daily data with datetime index and catchments as columns, on the days of
+        the catchments' own series, NaN on days outside a catchment's series
+    """
+    folder = Path(root)/"daily"/region
+    index = _readIndex(folder)
+    stored = np.load(folder/f"{variable}.npy",mmap_mode="r")
+    if catchments is None:
+        catchments = index["catchments"]
+    columns = [index["catchments"].index(c) for c in catchments]
+    dates = pd.date_range(index["start"],periods=index["days"])
+    df = pd.DataFrame(np.array(stored[:,columns]),index=dates,columns=catchments)
+    # stores written without masks keep the shared index
+    if (folder/f"{variable}_present.npy").exists():
+        present = np.unpackbits(np.load(folder/f"{variable}_present.npy")[columns],axis=-1,count=index["days"]).astype(bool)
+        df = df[present.any(axis=0)]
+    return df
+
+def loadSelection(root="Store"):
+    """
+    Loads the final selection of catchments, as in finalSelectionList.pkl.
+
+    Returns
+    -------
+    dictionary
+        {region:{30:[catchments],50:[catchments]}}
+    """
+    final = {}
+    for region in regions(root=root):
+        index = _readIndex(Path(root)/"daily"/region)
+        final[region] = {30:index["final30"],50:index["final50"]}
+    return final
+
+class _Catchments(Mapping):
+    """
+    Read-only mapping of catchment number to its daily data, loaded on first access.
+    """
+    def __init__(self,region,catchments,root):
+        self.region = region
+        self.catchments = catchments
+        self.root = root
+        self.loaded = {}
+
+    def __getitem__(self,c):
+        if c not in self.catchments:
+            raise KeyError(c)
+        if c not in self.loaded:
+            out = {}
+            for var,column in DAILY.items():
+                ts = loadDaily(self.region,var,catchments=[c],root=self.root)[c]
+                out[var] = ts.rename(var) if column is None else ts.to_frame(column)
+            self.loaded[c] = out
+        return self.loaded[c]
+
+    def __iter__(self):
+        return iter(self.catchments)
+
+    def __len__(self):
+        return len(self.catchments)
+
+def loadRegion(region,root="Store"):
+    """
+    Loads a region in the structure of the pickled regional dictionaries.
+
+    The daily data of a catchment is only read from the store when it is accessed
+    through ["data"][catchment].
+
+    Parameters
+    ----------
+    region: str
+        short name of region, e.g. "sor"
+    root: str
+        store directory
+
+    Returns
+    -------
+    dictionary with "order", "data", "metadata", "final30" and "final50"
+    """
+    folder = Path(root)/"daily"/region
+    index = _readIndex(folder)
+    return {"order":index["catchments"],
+            "data":_Catchments(region,index["catchments"],root),
+            "metadata":pd.read_csv(folder/"metadata.csv"),
+            "final30":index["final30"],
+            "final50":index["final50"]}
+
+if __name__ == "__main__":
+    root = input("Store directory (press Enter for 'Store'):") or "Store"
+    print("Writing regional dictionaries...")
+    for region,name in REGIONS.items():
+        pickle_in = open(f"{name}_final.pkl","rb")
+        writeRegion(pickle.load(pickle_in),region,root=root)
+        print(f"\t{region} finished.")
+    print("Writing moving average dictionaries...")
+    for file in sorted(Path(".").glob("MA_*_*year.pkl")):
+        variable, period = file.stem.split("_")[1:]
+        pickle_in = open(file,"rb")
+        writeMA(pickle.load(pickle_in),variable,int(period[:-4]),root=root)
+        print(f"\t{file.stem} finished.")
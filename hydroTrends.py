@@ -0,0 +1,398 @@
+"""
+    Command line interface for the daily and annual trend analysis.
+
+    Runs every stage of the pipeline without interactive prompts, e.g.:
+        python hydroTrends.py ma rainfall snowmelt --period 30 50
+        python hydroTrends.py reshape rainfall --period 30
+        python hydroTrends.py reshape rainfall --period 50 --compact
+        python hydroTrends.py trends streamflow --period 50 --regions ost vest
+        python hydroTrends.py magnitude snowmelt --period 30 --averages 10day
+        python hydroTrends.py bundle rainfall --period 30 50
+        python hydroTrends.py bundle rainfall --national
+        python hydroTrends.py append rainfall --year 2013 --source MA_rainfall_2013.pkl
+        python hydroTrends.py fieldsign --variable rainfall --workers 8
+        python hydroTrends.py fieldsign --variable rainfall --backend numba
+        python hydroTrends.py fieldsign --variable rainfall --record
+        python hydroTrends.py fieldsign --variable rainfall --method fdr
+        python hydroTrends.py threshold rainfall --alpha 0.05 --q 95
+        python hydroTrends.py annual
+        python hydroTrends.py run jobs.json
+        python hydroTrends.py --log run.log --profile cprofile run jobs.json
+
+    A job spec is a json file with a list of jobs, each expanding to all
+    combinations of its variables, periods, regions and moving averages.
+    Values missing in a job are taken from "defaults":
+        {
+            "defaults": {"periods": [30,50],
+                         "regions": ["sor","ost","vest","trond","nord","finn"],
+                         "averages": ["5day","10day","30day"]},
+            "jobs": [
+                {"stage": "reshape", "variables": ["rainfall","snowmelt"]},
+                {"stage": "trends", "variables": ["streamflow"], "periods": [30]},
+                {"stage": "fieldsign", "variables": ["rainfall"], "workers": 8},
+                {"stage": "annual"}
+            ]
+        }
+    All jobs run in one process, and each variable and period is only loaded once.
+
+    With --log, the time of each stage, the progress of long loops and a summary
+    per job are appended to a file as json records (see instrumentation.py).
+    """
+
+import argparse
+import json
+import os
+from pathlib import Path
+import runTrendAnalysis
+import runTrendMagnitude
+import reshapeToArray
+import dailyFieldSignificance
+import annualFieldSignificance
+import dataStore
+import movingAverages
+import significance
+import instrumentation
+
+REGIONS = ["sor","ost","vest","trond","nord","finn"]
+AVERAGES = ["5day","10day","30day"]
+
+def loadVariable(variable,period,cache,source=None):
+    """
+    Finds the moving average data of a variable, loading it only once per run.
+
+    Parameters
+    ----------
+    variable: str
+    period: int
+    cache: dictionary
+        data loaded earlier in the run
+    source: str
+        pickle file to read instead of the default MA_<variable>_<period>year.pkl
+
+    Returns
+    -------
+    dictionary, or the variable name if it is read from the data store
+    """
+    key = ("MA",variable,int(period),source)
+    if key not in cache:
+        if source is None and (Path("Store")/"MA"/variable/f"{period}year").is_dir():
+            cache[key] = variable
+        else:
+            file = source or f"MA_{variable}_{period}year.pkl"
+            cache[key] = runTrendAnalysis.openDict(file)
+    return cache[key]
+
+def loadSelection(cache):
+    """
+    Loads the final selection of catchments once per run.
+    """
+    if "final" not in cache:
+        cache["final"] = runTrendAnalysis.loadSelection()
+    return cache["final"]
+
+def loadRegion(region,cache):
+    """
+    Loads the organised data of a region once per run.
+    """
+    key = ("region",region)
+    if key not in cache:
+        cache[key] = annualFieldSignificance.loadRegion(region)
+    return cache[key]
+
+def availableRegions(data=None,period=30):
+    """
+    Regions in the moving average data of a variable, see loadVariable, or if data
+    is None the regions with organised daily data, see annualFieldSignificance.loadRegion.
+    """
+    if data is None:
+        if dataStore.exists():
+            return dataStore.regions() if (Path("Store")/"daily").is_dir() else []
+        return [r for r,name in dataStore.REGIONS.items() if Path(f"{name}_final.pkl").exists()]
+    if isinstance(data,str):
+        return dataStore.regions(data,period=period)
+    return list(data.keys())
+
+def selectRegions(regions,available):
+    """
+    Checks the selected regions against the available regions, all available
+    regions if regions is None.
+    """
+    if regions is None:
+        return list(available)
+    missing = [r for r in regions if r not in available]
+    if missing:
+        raise ValueError(f"Regions not in the data: {', '.join(missing)}; available regions: {', '.join(available)}")
+    return list(regions)
+
+def runStage(stage,variables=(),periods=(30,),regions=None,averages=AVERAGES,
+             cache=None,source=None,workers=1,seed=0,chunk=30,NS=400,alpha=None,endYear=2012,year=None,
+             keepFeb29=False,adaptive=False,backend="numpy",record=False,q=90,national=False,compact=False,
+             method="bootstrap"):
+    """
+    Runs one stage of the pipeline for all combinations of variables, periods,
+    regions and moving averages.
+
+    Parameters
+    ----------
+    stage: str
+        {"ma","reshape","trends","magnitude","bundle","append","fieldsign","threshold","annual"},
+        "ma" writes the reshaped arrays directly from the daily data
+        "bundle" runs the trend analysis once and saves the results of
+        both "trends" and "magnitude" together with the p-values
+        "threshold" derives the significant trends and the field significance at
+        alpha and q from the results of "bundle" and "fieldsign" with record
+    variables: list
+    periods: list
+    regions: list
+        default is all regions in the data, or REGIONS for "fieldsign" and "threshold",
+        which skip regions without results
+    averages: list
+    cache: dictionary
+        data shared between stages of one run
+    source: str
+        pickle file with the moving average data, instead of the default
+    workers: int
+        processes for the field significance bootstrap
+    seed: int
+        seed of the field significance bootstrap
+    chunk: int
+        number of DOYs read at a time in the field significance
+    NS: int
+        number of bootstrap samples
+    alpha: float
+        significance level, default is the default of each stage
+    endYear: int
+        last year of the period
+    year: int
+        new year added by "append" to the data store and the reshaped arrays,
+        read from the pickle file source
+    keepFeb29: bool
+        "ma", "reshape" and "append" leave out 31 December in leap years instead of 29 February,
+        see reshapeToArray.dayIndex
+    adaptive: bool
+        field significance stops resampling once the result is decided
+    backend: str
+        {"numpy","numba","trend","auto"}, backend of the trend tests, see kernels.py
+    record: bool
+        field significance also saves the p-values of all samples for "threshold"
+    q: float
+        percentile of the field significance used by "threshold"
+    national: bool
+        "bundle" and "fieldsign" analyse all regions as one cube, and also save
+        the field significance of all catchments together as region "norway"
+    compact: bool
+        "ma", "reshape", "trends", "magnitude" and "bundle" use float32 arrays with a
+        validity mask instead of -99 for missing catchments, see compactCube.py;
+        "fieldsign" finds the masks itself
+    method: str
+        {"bootstrap","fdr","walker"}, field significance of "fieldsign" and "annual",
+        "fdr" (Benjamini-Hochberg) and "walker" test the p-values without
+        resampling, see significance.analyticFieldSignificance, and are saved
+        next to the bootstrap results
+    """
+    if cache is None:
+        cache = {}
+    if stage == "annual":
+        regions = selectRegions(regions,availableRegions())
+        regionDF = {region:loadRegion(region,cache) for region in regions}
+        kwargs = {} if alpha is None else {"alpha":alpha}
+        out = annualFieldSignificance.annualFieldSignificance(regionDF,regions=regions,years=list(periods),
+                                                              NS=NS,seed=seed,adaptive=adaptive,method=method,**kwargs)
+        annualFieldSignificance.saveDict(out,"Results/FS/FieldSignificanceAnnual"+("" if method == "bootstrap" else f"_{method}"))
+        return
+    for variable in variables:
+        for period in periods:
+            if stage in ("fieldsign","threshold") and regions is None:
+                regions = REGIONS
+            if stage == "fieldsign":
+                files = [f"Reshaped/{variable}_{region}_{MA}_{period}year.npy" for region in regions for MA in averages]
+                kwargs = {} if alpha is None else {"alpha":alpha}
+                if national:
+                    if method != "bootstrap":
+                        raise ValueError("national field significance needs the bootstrap method")
+                    dailyFieldSignificance.fieldSignNational(variable,period,regions,averages=averages,seed=seed,
+                                                             workers=workers,chunk=chunk,NS=NS,backend=backend,**kwargs)
+                    continue
+                if adaptive:
+                    kwargs["adaptive"] = True
+                dailyFieldSignificance.fieldSignFiles([f for f in files if Path(f).exists()],
+                                                      seed=seed,workers=workers,chunk=chunk,NS=NS,backend=backend,
+                                                      record=record,method=method,**kwargs)
+                continue
+            if stage == "threshold":
+                significance.thresholdFiles(variable,period,regions,averages=averages,
+                                            alpha=0.1 if alpha is None else alpha,q=q)
+                continue
+            if stage == "ma":
+                for region in selectRegions(regions,availableRegions()):
+                    movingAverages.writeMAArrays(loadRegion(region,cache),variable,region,int(period),endYear=endYear,
+                                                 averages=averages,dropLeapDay=not keepFeb29,compact=compact)
+                continue
+            if stage == "append":
+                data = runTrendAnalysis.openDict(source)
+                selected = selectRegions(regions,availableRegions(data))
+                if (Path("Store")/"MA"/variable/f"{period}year").is_dir():
+                    dataStore.appendYear(data,variable,int(period),year,dropLeapDay=not keepFeb29)
+                if any(Path(f"Reshaped/{variable}_{region}_{MA}_{period}year.npy").exists()
+                       for region in selected for MA in averages):
+                    reshapeToArray.appendYear(data,variable,int(period),year,averages=averages,regions=selected,
+                                              dropLeapDay=not keepFeb29)
+                continue
+            data = loadVariable(variable,period,cache,source=source)
+            selected = selectRegions(regions,availableRegions(data,period=period))
+            if stage == "reshape":
+                reshapeToArray.reshapeArrays(data,variable,int(period),averages=averages,regions=selected,endYear=endYear,
+                                             compact=compact,dropLeapDay=not keepFeb29)
+            elif stage == "trends":
+                kwargs = {} if alpha is None else {"alpha":alpha}
+                runTrendAnalysis.trendArrays(data,variable,period,loadSelection(cache),
+                                             averages=averages,regions=selected,endYear=endYear,backend=backend,compact=compact,**kwargs)
+            elif stage == "magnitude":
+                runTrendMagnitude.trendArrays(data,variable,period,loadSelection(cache),
+                                              averages=averages,regions=selected,endYear=endYear,backend=backend,compact=compact)
+            elif stage == "bundle":
+                kwargs = {} if alpha is None else {"alpha":alpha}
+                if national:
+                    runTrendAnalysis.nationalBundles(data,variable,period,loadSelection(cache),
+                                                     averages=averages,regions=selected,endYear=endYear,backend=backend,compact=compact,**kwargs)
+                    continue
+                runTrendAnalysis.trendBundles(data,variable,period,loadSelection(cache),
+                                              averages=averages,regions=selected,endYear=endYear,backend=backend,compact=compact,**kwargs)
+            else:
+                raise ValueError(f"Unknown stage: {stage}")
+
+def runJobs(spec):
+    """
+    Runs all jobs of a job spec in one process.
+
+    Parameters
+    ----------
+    spec: dictionary or str
+        job spec, or path to a json file with the job spec
+    """
+    if not isinstance(spec,dict):
+        with open(spec) as f:
+            spec = json.load(f)
+    defaults = spec.get("defaults",{})
+    cache = {}
+    for i,job in enumerate(spec["jobs"]):
+        job = {**defaults,**job}
+        stage = job.pop("stage")
+        print(f"=== Job {i+1} of {len(spec['jobs'])}: {stage} ===")
+        instrumentation.log("job",number=i+1,stage=stage,**job)
+        runStage(stage,cache=cache,**job)
+        instrumentation.summary()
+
+def parser():
+    """
+    Builds the argument parser with one subcommand per stage.
+    """
+    p = argparse.ArgumentParser(description="Daily and annual hydrological trend analysis.")
+    p.add_argument("--log",help="file the json log records are appended to")
+    p.add_argument("--profile",choices=["cprofile","tracemalloc"],help="profile the run")
+    p.add_argument("--profileOutput",default="profile.out",help="file of the cProfile statistics")
+    sub = p.add_subparsers(dest="command",required=True)
+
+    def matrix(s,variable=True):
+        if variable:
+            s.add_argument("variables",nargs="+",help="variables, e.g. rainfall streamflow")
+        s.add_argument("--periods","--period",nargs="+",type=int,default=[30],help="number of years in period")
+        s.add_argument("--regions",nargs="+",help="default is all regions in the data")
+        s.add_argument("--averages",nargs="+",default=AVERAGES)
+
+    def backendArgument(s,reference=True):
+        if reference:
+            s.add_argument("--backend",choices=["numpy","numba","trend","auto"],default="numpy",
+                           help="trend test backend, numba needs numba installed, trend is the slow reference")
+        else:
+            s.add_argument("--backend",choices=["numpy","numba","auto"],default="numpy",
+                           help="trend test backend, numba needs numba installed")
+
+    def methodArgument(s):
+        s.add_argument("--method",choices=["bootstrap","fdr","walker"],default="bootstrap",
+                       help="field significance test, fdr and walker test the p-values without resampling")
+
+    def compactArgument(s):
+        s.add_argument("--compact",action="store_true",help="float32 arrays with a validity mask instead of -99 fills")
+
+    def leapDayArgument(s):
+        s.add_argument("--keepFeb29",action="store_true",help="leave out 31 December in leap years instead of 29 February")
+
+    s = sub.add_parser("ma",help="moving averages of the daily data directly to (doy,year,catchment) arrays")
+    matrix(s)
+    s.add_argument("--endYear",type=int,default=2012,help="last year of the period")
+    leapDayArgument(s)
+    compactArgument(s)
+    s = sub.add_parser("reshape",help="reshape moving averages to (doy,year,catchment) arrays")
+    matrix(s)
+    s.add_argument("--source",help="pickle file with the moving average dictionary")
+    s.add_argument("--endYear",type=int,default=2012,help="last year of the period")
+    leapDayArgument(s)
+    compactArgument(s)
+    for name,text in (("trends","trend magnitude where the trend is significant"),
+                      ("magnitude","trend magnitude without significance level"),
+                      ("bundle","p-values and trend magnitude with and without significance level in one pass")):
+        s = sub.add_parser(name,help=text)
+        matrix(s)
+        s.add_argument("--source",help="pickle file with the moving average dictionary")
+        s.add_argument("--endYear",type=int,default=2012,help="last year of the period")
+        if name != "magnitude":
+            s.add_argument("--alpha",type=float)
+        if name == "bundle":
+            s.add_argument("--national",action="store_true",help="analyse all regions as one cube")
+        # the bundle is computed by batchTrend.trendBundle, which has no trend backend
+        backendArgument(s,reference=name!="bundle")
+        compactArgument(s)
+    s = sub.add_parser("append",help="add a year to the data store and move the reshaped arrays on by one year")
+    matrix(s)
+    s.add_argument("--year",type=int,required=True)
+    s.add_argument("--source",required=True,help="pickle file with the moving averages of the new year")
+    leapDayArgument(s)
+    s = sub.add_parser("fieldsign",help="daily field significance of reshaped arrays")
+    matrix(s,variable=False)
+    s.add_argument("--variables","--variable",nargs="+",required=True)
+    s.add_argument("--workers",type=int,default=os.cpu_count())
+    s.add_argument("--seed",type=int,default=0)
+    s.add_argument("--chunk",type=int,default=30)
+    s.add_argument("--NS",type=int,default=400)
+    s.add_argument("--alpha",type=float)
+    s.add_argument("--adaptive",action="store_true",help="stop resampling once the field significance is decided")
+    s.add_argument("--record",action="store_true",help="also save the p-values of all samples, for threshold")
+    s.add_argument("--national",action="store_true",
+                   help="analyse all regions as one cube and add the field significance of all catchments")
+    methodArgument(s)
+    backendArgument(s)
+    s = sub.add_parser("threshold",help="significant trends and field significance at another alpha and q from saved p-values")
+    matrix(s)
+    s.add_argument("--alpha",type=float,default=0.1)
+    s.add_argument("--q",type=float,default=90)
+    s = sub.add_parser("annual",help="annual field significance")
+    s.add_argument("--periods","--period",nargs="+",type=int,default=[30,50])
+    s.add_argument("--regions",nargs="+",help="default is all regions in the data")
+    s.add_argument("--seed",type=int,default=0)
+    s.add_argument("--NS",type=int,default=400)
+    s.add_argument("--alpha",type=float)
+    s.add_argument("--adaptive",action="store_true",help="stop resampling once the field significance is decided")
+    methodArgument(s)
+    s = sub.add_parser("run",help="run all jobs of a json job spec")
+    s.add_argument("spec",help="json file")
+    return p
+
+def main(args=None):
+    p = parser()
+    args = vars(p.parse_args(args))
+    command = args.pop("command")
+    if command == "fieldsign" and args["backend"] == "trend":
+        options = [f"--{k}" for k in ("record","national","adaptive") if args[k]]
+        if options:
+            p.error(f"--backend trend cannot be used with {' '.join(options)}, use numpy or numba")
+    instrumentation.configure(args.pop("log"))
+    with instrumentation.profile(args.pop("profile"),output=args.pop("profileOutput")):
+        if command == "run":
+            runJobs(args["spec"])
+        else:
+            runStage(command,**args)
+            instrumentation.summary()
+
+if __name__ == "__main__":
+    main()
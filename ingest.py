@@ -0,0 +1,139 @@
+"""
+    Reading of the raw runoff and seNorge text files into the organised regional dictionaries.
+
+    Same results as readRunoff, readSnow, readSeNorge and organiseData in the
+    catchment selection notebook, with the dates of each file built in one
+    vectorised call, the catchments read in parallel, and each catchment cached
+    as a binary .npz file, so that later runs skip the text parsing. A cached
+    catchment is read again when the size or modification time of one of its
+    text files changed.
+    """
+
+import json
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+def runoffFile(catchmentNo,folder="runoff"):
+    return Path(folder)/f"{catchmentNo}.txt"
+
+def seNorgeFile(regine,main,variable,folder="seNorge"):
+    """
+    Path of a seNorge file, variable is "rr_tm" (precipitation and temperature) or "qsw" (snowmelt).
+    """
+    return Path(folder)/f"{regine}.{main}"/f"{regine}.{main}_SeNorge_{variable}_1959_2014.dta"
+
+def readRunoff(catchmentNo,folder="runoff"):
+    # reading data, dates are converted in one call
+    runoff = pd.read_csv(runoffFile(catchmentNo,folder),
+                         header=None, sep=" ", names=["date","runoff"],usecols=[0,1],index_col=0)
+    runoff.index = pd.to_datetime(runoff.index,cache=True)
+    # replacing invalid values with nan
+    runoff = runoff.replace(-9999.,np.nan)
+    return runoff
+
+def readTable(file,names):
+    """
+    Reads a whitespace delimited seNorge file with year, month and day columns.
+
+    Returns
+    -------
+    pandas.DataFrame with datetime index and the remaining columns
+    """
+    data = pd.read_csv(file,sep=r"\s+",header=None,names=["year","month","day"]+names)
+    # dates from the year, month and day columns in one call
+    data.index = pd.DatetimeIndex(pd.to_datetime(data[["year","month","day"]]))
+    return data.drop(["year","month","day"],axis = 1)
+
+def readSnow(regine,main,folder="seNorge"):
+    return readTable(seNorgeFile(regine,main,"qsw",folder),["qsw"])
+
+def readSeNorge(regine,main,folder="seNorge"):
+    return readTable(seNorgeFile(regine,main,"rr_tm",folder),["precip","temp"])
+
+def _sources(catchmentNo,regine,main,runoffDir,seNorgeDir):
+    """
+    Size and modification time of the text files of a catchment.
+    """
+    files = [runoffFile(catchmentNo,runoffDir),
+             seNorgeFile(regine,main,"qsw",seNorgeDir),
+             seNorgeFile(regine,main,"rr_tm",seNorgeDir)]
+    return {str(f):[f.stat().st_size,f.stat().st_mtime_ns] for f in files}
+
+def readCatchment(catchmentNo,regine,main,cacheDir="Cache/ingest",runoffDir="runoff",seNorgeDir="seNorge"):
+    """
+    Reads the runoff, snowmelt, precipitation and temperature of a catchment,
+    from the binary cache if its text files did not change.
+
+    Parameters
+    ----------
+    catchmentNo: int
+    regine: int
+    main: int
+    cacheDir: str
+        cache directory, None to always read the text files
+    runoffDir: str
+    seNorgeDir: str
+
+    Returns
+    -------
+    dictionary with "runoff", "snow", "temp" and "precip", as in organiseData
+    """
+    sources = json.dumps(_sources(catchmentNo,regine,main,runoffDir,seNorgeDir))
+    file = None if cacheDir is None else Path(cacheDir)/f"{catchmentNo}.npz"
+    if file is not None and file.exists():
+        with np.load(file) as cached:
+            if str(cached["sources"]) == sources:
+                runoffDates = pd.DatetimeIndex(cached["runoffDates"],name="date")
+                snowDates = pd.DatetimeIndex(cached["snowDates"])
+                seNorgeDates = pd.DatetimeIndex(cached["seNorgeDates"])
+                return {"runoff":pd.DataFrame({"runoff":cached["runoff"]},index=runoffDates),
+                        "snow":pd.DataFrame({"qsw":cached["qsw"]},index=snowDates),
+                        "temp":pd.Series(cached["temp"],index=seNorgeDates,name="temp"),
+                        "precip":pd.Series(cached["precip"],index=seNorgeDates,name="precip")}
+    runoff = readRunoff(catchmentNo,runoffDir)
+    snow = readSnow(regine,main,seNorgeDir)
+    pt = readSeNorge(regine,main,seNorgeDir)
+    if file is not None:
+        file.parent.mkdir(parents=True,exist_ok=True)
+        np.savez(f"{file}.tmp.npz",sources=sources,
+                 runoffDates=runoff.index.values,runoff=runoff.runoff.values,
+                 snowDates=snow.index.values,qsw=snow.qsw.values,
+                 seNorgeDates=pt.index.values,precip=pt.precip.values,temp=pt.temp.values)
+        os.replace(f"{file}.tmp.npz",file)
+    return {"runoff":runoff,"snow":snow,"temp":pt.temp,"precip":pt.precip}
+
+def organiseData(region,workers=1,**kwargs):
+    """
+    Organises all data for a region into a dictionary.
+
+    Parameters
+    -----------
+    region: pandas.DataFrame
+        metadata with snumber, regine and main of each catchment, ordered by elevation
+    workers: int
+        number of processes reading catchments in parallel
+    kwargs:
+        further arguments to readCatchment, e.g. cacheDir
+
+    Returns
+    -----------
+    dictionary with all variables
+    """
+    # create dictionary and adds station order by elevation
+    d = {"order":list(region.snumber),
+         "data":{},
+         "metadata":region}
+    args = [(c,int(regine),int(main)) for c,regine,main in zip(region.snumber,region.regine,region.main)]
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(readCatchment,*a,**kwargs) for a in args]
+            for a,future in zip(args,futures):
+                d["data"][a[0]] = future.result()
+    else:
+        for a in args:
+            d["data"][a[0]] = readCatchment(*a,**kwargs)
+    # return the finished dictionary
+    return d
@@ -0,0 +1,161 @@
+"""
+    Measurements of resource use and progress for long pipeline runs.
+
+    Stages are timed with the stage context manager, loops report their rate and
+    ETA with Progress, and with configure(logFile) every measurement is also
+    appended to a log file as one json record per line, e.g.:
+        {"time": "2019-08-01T12:00:00", "event": "stage", "stage": "mk", "seconds": 0.8}
+    """
+
+import cProfile
+import json
+import resource
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+def peakRSS(children=True):
+    """
+    Peak resident set size of this process in MB.
+
+    Parameters
+    ----------
+    children: bool
+        also include the largest finished child process, e.g. pool workers
+
+    Returns
+    -------
+    float
+    """
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    scale = 1024**2 if sys.platform == "darwin" else 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if children:
+        peak = max(peak,resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak/scale
+
+# total seconds and number of calls of each stage in this process
+TIMES = defaultdict(lambda: [0.,0])
+# file for the machine-readable log, one json record per line, None for no log
+LOG = None
+
+def configure(logFile=None):
+    """
+    Sets the file the log records are appended to, None to stop logging.
+    """
+    global LOG
+    LOG = logFile
+
+def log(event,**fields):
+    """
+    Appends a json record with a timestamp and the event name to the log file.
+    """
+    if LOG is None:
+        return
+    record = {"time":time.strftime("%Y-%m-%dT%H:%M:%S"),"event":event,**fields}
+    with open(LOG,"a") as f:
+        f.write(json.dumps(record,default=str)+"\n")
+
+@contextmanager
+def stage(name,**fields):
+    """
+    Times a stage of the pipeline, e.g. load, reshape, acf, prewhiten, mk, sen,
+    resample or write. The times are summed per stage in TIMES and each run of a
+    stage is logged with fields.
+    """
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter()-t0
+        TIMES[name][0] += seconds
+        TIMES[name][1] += 1
+        log("stage",stage=name,seconds=round(seconds,6),**fields)
+
+def summary(reset=True):
+    """
+    Logs and prints the total time of each stage since the last summary.
+
+    Returns
+    -------
+    dictionary {stage:seconds}
+    """
+    totals = {name:round(t,3) for name,(t,n) in sorted(TIMES.items(),key=lambda kv: -kv[1][0])}
+    if totals:
+        log("summary",seconds=totals,calls={name:TIMES[name][1] for name in totals},peakRSS=round(peakRSS()))
+        print("Time per stage: "+", ".join(f"{name} {t:.1f} s" for name,t in totals.items()))
+    if reset:
+        TIMES.clear()
+    return totals
+
+class Progress:
+    """
+    Progress of a loop with iteration rate and estimated time to completion.
+
+    Prints and logs at most every interval seconds and at the end, e.g.:
+        progress = Progress(NS,"bootstrap")
+        for i in range(NS):
+            ...
+            progress.update()
+    """
+    def __init__(self,total,label,interval=10.,**fields):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.fields = fields
+        self.done = 0
+        self.start = self.last = time.perf_counter()
+
+    def update(self,n=1):
+        self.done += n
+        now = time.perf_counter()
+        if now - self.last < self.interval and self.done < self.total:
+            return
+        self.last = now
+        elapsed = now - self.start
+        rate = self.done/elapsed if elapsed > 0 else float("inf")
+        eta = (self.total-self.done)/rate if rate > 0 else float("nan")
+        print(f"\t{self.label}: {self.done} of {self.total} ({100*self.done/self.total:.0f}%), "
+              f"{rate:.2f}/s, ETA {time.strftime('%H:%M:%S',time.gmtime(eta)) if eta == eta else '?'}")
+        log("progress",label=self.label,done=self.done,total=self.total,rate=round(rate,4),
+            eta=round(eta,1),**self.fields)
+
+@contextmanager
+def profile(kind=None,output="profile.out"):
+    """
+    Optionally profiles a block of code.
+
+    Parameters
+    ----------
+    kind: str
+        None for no profiling, "cprofile" to save cProfile statistics to output
+        (read with pstats), or "tracemalloc" to log the peak and the largest
+        allocations of python and numpy memory
+    output: str
+    """
+    if kind is None:
+        yield
+    elif kind == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(output)
+            log("profile",kind=kind,output=output)
+    elif kind == "tracemalloc":
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            top = [str(s) for s in snapshot.statistics("lineno")[:10]]
+            print(f"Peak traced memory: {peak/1024**2:.0f} MB")
+            log("profile",kind=kind,peakMB=round(peak/1024**2,1),top=top)
+    else:
+        raise ValueError(f"Unknown profiler: {kind}")
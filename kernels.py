@@ -0,0 +1,308 @@
+"""
+    Compiled per-series kernels for the trend analysis and the field significance bootstrap.
+
+    With numba installed, the kernels are compiled (parallel over series, without
+    the GIL) and compute the autocorrelation test, prewhitening, Mann-Kendall
+    test and Sen's slope of each series without the large temporary arrays of the
+    vectorised numpy functions in batchTrend. Without numba the "numba" backend
+    is not available and "auto" falls back to "numpy".
+
+    Backends, selected with the backend argument of the trend and field
+    significance functions:
+        "numpy"  vectorised numpy functions of batchTrend and bootstrap
+        "numba"  the compiled kernels of this module
+        "trend"  statsmodels and the USGS trend module per series, the reference
+        "auto"   "numba" if numba is installed, else "numpy"
+
+    The backends are compared on synthetic data by tests/test_kernels.py.
+    """
+
+import math
+import numpy as np
+
+try:
+    from numba import njit, prange
+    NUMBA = True
+except ImportError:
+    NUMBA = False
+
+    def njit(*args,**kwargs):
+        """
+        Leaves the kernels as plain python functions when numba is not installed.
+        """
+        return lambda f: f
+    prange = range
+
+BACKENDS = ("numpy","numba","trend")
+
+def resolve(backend):
+    """
+    Returns the backend to use for backend, checking that it is available.
+    """
+    if backend == "auto":
+        return "numba" if NUMBA else "numpy"
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}")
+    if backend == "numba" and not NUMBA:
+        raise ImportError("the numba backend needs numba, pip install numba")
+    return backend
+
+@njit(cache=True,nogil=True,error_model="numpy")
+def _pvalue(s,varS):
+    """
+    Two tailed p-value of the Mann-Kendall S statistic.
+    """
+    if s > 0:
+        z = (s-1)/math.sqrt(varS)
+    elif s < 0:
+        z = (s+1)/math.sqrt(varS)
+    else:
+        z = 0.
+    # 2*(1-norm.cdf(|z|))
+    return math.erfc(abs(z)/math.sqrt(2.))
+
+@njit(cache=True,nogil=True,error_model="numpy")
+def _mannKendall(x):
+    """
+    S statistic and tie corrected variance of one series, missing values dropped.
+    """
+    n = x.shape[0]
+    s = 0.
+    for j in range(1,n):
+        if math.isnan(x[j]):
+            continue
+        for i in range(j):
+            if not math.isnan(x[i]):
+                if x[j] > x[i]:
+                    s += 1
+                elif x[j] < x[i]:
+                    s -= 1
+    valid = np.sort(x[~np.isnan(x)])
+    m = valid.shape[0]
+    ties = 0.
+    t = 1
+    for i in range(1,m+1):
+        if i < m and valid[i] == valid[i-1]:
+            t += 1
+        else:
+            ties += t*(t-1)*(2*t+5)
+            t = 1
+    return s, (m*(m-1)*(2*m+5) - ties)/18
+
+@njit(cache=True,nogil=True,error_model="numpy")
+def _senSlope(x):
+    """
+    Median of the slopes of all pairs of values, NaN if the series has missing values.
+    """
+    n = x.shape[0]
+    slopes = np.empty(n*(n-1)//2)
+    k = 0
+    for i in range(n):
+        for j in range(i+1,n):
+            slopes[k] = (x[j]-x[i])/(j-i)
+            k += 1
+    if np.isnan(slopes).any():
+        return np.nan
+    return np.median(slopes)
+
+@njit(cache=True,nogil=True,error_model="numpy")
+def _prewhiten(x,alpha,out):
+    """
+    Writes the prewhitened series to out if its lag-1 autocorrelation is significant
+    (Ljung-Box test), else the series itself. Returns True if it was prewhitened.
+    """
+    n = x.shape[0]
+    mean = x.mean()
+    num = 0.
+    den = (x[0]-mean)**2
+    for i in range(1,n):
+        num += (x[i]-mean)*(x[i-1]-mean)
+        den += (x[i]-mean)**2
+    r = num/den
+    # chi2.sf(Q,1) = erfc(sqrt(Q/2))
+    p = math.erfc(math.sqrt(n*(n+2)*r**2/(n-1)/2))
+    out[:] = x
+    if not p < alpha:
+        return False
+    for i in range(1,n-1):
+        out[i] = (x[i] - r*x[i-1])/(1 - r)
+    return True
+
+@njit(cache=True,nogil=True,parallel=True,error_model="numpy")
+def _trendSeries(x,alpha):
+    series = x.shape[0]
+    p = np.empty(series)
+    s = np.empty(series)
+    slope = np.empty(series)
+    prewhitened = np.empty(series,dtype=np.bool_)
+    for k in prange(series):
+        pw = np.empty(x.shape[1],dtype=x.dtype)
+        prewhitened[k] = _prewhiten(x[k],alpha,pw)
+        s[k], varS = _mannKendall(pw)
+        p[k] = _pvalue(s[k],varS)
+        slope[k] = _senSlope(pw)
+    return p, s, slope, prewhitened
+
+def trendSeries(array,axis=1,alpha=0.05):
+    """
+    Autocorrelation test, prewhitening, Mann-Kendall test and Sen's slope of every series,
+    as batchTrend.prewhiten, batchTrend.mannKendall and batchTrend.senSlope.
+
+    Parameters
+    ----------
+    array: numpy.array
+        array containing time series along one axis
+    axis: int
+        axis of the time dimension
+    alpha: float
+        significance level of the autocorrelation test
+
+    Returns
+    -------
+    tuple of numpy.array
+        p-values, S, Sen's slope and prewhitening mask, all with the time axis removed
+    """
+    import batchTrend
+    # float32 arrays are analysed in float32
+    x = batchTrend._moveYearAxis(array,axis)
+    shape = x.shape[:-1]
+    out = _trendSeries(np.ascontiguousarray(x.reshape(-1,x.shape[-1])),alpha)
+    return tuple(o.reshape(shape) for o in out)
+
+@njit(cache=True,nogil=True,parallel=True,error_model="numpy")
+def _mannKendallSeries(x):
+    p = np.empty(x.shape[0])
+    s = np.empty(x.shape[0])
+    for k in prange(x.shape[0]):
+        s[k], varS = _mannKendall(x[k])
+        p[k] = _pvalue(s[k],varS)
+    return p, s
+
+def mannKendall(array,axis=1):
+    """
+    Mann-Kendall test of every series, as batchTrend.mannKendall.
+
+    Returns
+    -------
+    tuple of numpy.array
+        two tailed p-values and S statistics, both with the time axis removed
+    """
+    import batchTrend
+    x = batchTrend._moveYearAxis(array,axis)
+    shape = x.shape[:-1]
+    p, s = _mannKendallSeries(np.ascontiguousarray(x.reshape(-1,x.shape[-1])))
+    return p.reshape(shape), s.reshape(shape)
+
+@njit(cache=True,nogil=True)
+def _rankScore(r,counts):
+    """
+    S statistic and tie corrected variance of one series of ranks, -1 for missing values.
+    """
+    n = r.shape[0]
+    s = 0
+    counts[:] = 0
+    for j in range(n):
+        rj = r[j]
+        if rj < 0:
+            continue
+        counts[rj] += 1
+        for i in range(j):
+            ri = r[i]
+            if ri >= 0:
+                if rj > ri:
+                    s += 1
+                elif rj < ri:
+                    s -= 1
+    m = 0
+    ties = 0
+    for t in counts:
+        m += t
+        ties += t*(t-1)*(2*t+5)
+    return s, (m*(m-1)*(2*m+5) - ties)/18
+
+@njit(cache=True,nogil=True,parallel=True,error_model="numpy")
+def _bootstrap(ranks,finite,table,alpha):
+    NS, days, n = table.shape
+    catchments = ranks.shape[1]
+    distribution = np.full((NS,days),np.nan)
+    for k in prange(NS*days):
+        i = k // days
+        d = k % days
+        index = table[i,d]
+        valid = True
+        for j in range(n):
+            valid &= finite[d,index[j]]
+        if not valid:
+            continue
+        r = np.empty(n,dtype=ranks.dtype)
+        counts = np.zeros(n,dtype=np.int64)
+        significant = 0
+        for c in range(catchments):
+            for j in range(n):
+                r[j] = ranks[d,c,index[j]]
+            s, varS = _rankScore(r,counts)
+            if _pvalue(s,varS) < alpha:
+                significant += 1
+        distribution[i,d] = significant/catchments
+    return distribution
+
+@njit(cache=True,nogil=True,parallel=True,error_model="numpy")
+def _bootstrapPValues(ranks,finite,table):
+    NS, days, n = table.shape
+    catchments = ranks.shape[1]
+    out = np.full((NS,days,catchments),np.nan,dtype=np.float32)
+    for k in prange(NS*days):
+        i = k // days
+        d = k % days
+        index = table[i,d]
+        valid = True
+        for j in range(n):
+            valid &= finite[d,index[j]]
+        if not valid:
+            continue
+        r = np.empty(n,dtype=ranks.dtype)
+        counts = np.zeros(n,dtype=np.int64)
+        for c in range(catchments):
+            for j in range(n):
+                r[j] = ranks[d,c,index[j]]
+            s, varS = _rankScore(r,counts)
+            out[i,d,c] = _pvalue(s,varS)
+    return out
+
+def bootstrapSignificance(array,table,alpha=0.1):
+    """
+    Proportion of catchments with a significant trend for each bootstrap sample,
+    as bootstrap.bootstrapSignificance, with the samples and DOYs spread over threads.
+
+    Parameters
+    ----------
+    array: 3D numpy array in the shape (DOY,years,catchments)
+    table: numpy array of year indices, shape: (NS,DOY,years)
+    alpha: float
+
+    Returns
+    -------
+    numpy array of shape (NS,DOY)
+    """
+    # imported here, as batchTrend itself imports this module
+    import batchTrend
+    array = np.asarray(array,dtype=float)
+    # (DOY,catchments,years), so that the years of a series are contiguous
+    ranks = np.ascontiguousarray(np.moveaxis(batchTrend.rankSeries(array),1,2))
+    finite = np.ascontiguousarray(np.isfinite(array[:,:,0]))
+    return _bootstrap(ranks,finite,np.ascontiguousarray(table),alpha)
+
+def bootstrapPValues(array,table,masked=True):
+    """
+    Mann-Kendall p-values of every catchment in every bootstrap sample, as
+    bootstrap.bootstrapPValues.
+
+    Returns
+    -------
+    float32 numpy array of shape (NS,DOY,catchments)
+    """
+    import batchTrend
+    array = np.asarray(array,dtype=float)
+    ranks = np.ascontiguousarray(np.moveaxis(batchTrend.rankSeries(array),1,2))
+    finite = np.ascontiguousarray(np.isfinite(array[:,:,0]) | (not masked))
+    return _bootstrapPValues(ranks,finite,np.ascontiguousarray(table))
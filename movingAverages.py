@@ -0,0 +1,150 @@
+"""
+    Moving averages of the daily data written directly to (doy,year,catchment) arrays.
+
+    Replaces extractMA in the catchment selection notebook, the pickled moving
+    average dictionaries and the reshaping of reshapeToArray.py with one pass over
+    the daily series: each catchment is read once, the centred 5, 10 and 30 day
+    means are computed together from one cumulative sum, and the period is written
+    into preallocated arrays, one per moving average.
+    """
+
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+import compactCube
+from reshapeToArray import dayIndex
+
+WINDOWS = {"5day":5,"10day":10,"30day":30}
+
+def dailySeries(data,variable,c):
+    """
+    Daily series of a catchment, as used for the moving averages in the catchment selection notebook.
+
+    Parameters
+    ----------
+    data: dictionary
+        organised data of a region
+    variable: str
+        {"streamflow","rainfall","snowmelt","temperature"}
+    c: int
+        catchment number
+
+    Returns
+    -------
+    pandas.Series
+    """
+    if variable == "streamflow":
+        df = data["metadata"]
+        area = float(df[df.snumber==c].areal.iloc[0])
+        # as in the notebook, the specific runoff is divided by the area a second time
+        return data["data"][c]["runoff"].runoff/area/area
+    elif variable == "rainfall":
+        return data["data"][c]["precip"]
+    elif variable == "snowmelt":
+        return data["data"][c]["snow"].qsw
+    elif variable == "temperature":
+        return data["data"][c]["temp"]
+    raise ValueError(f"Unknown variable: {variable}")
+
+def centredMeans(values,windows):
+    """
+    Centred moving means of a daily series for several windows from one cumulative sum.
+
+    Same as pandas rolling(window,center=True).mean(): the mean is NaN where the
+    window is not complete or contains a missing value.
+
+    Parameters
+    ----------
+    values: numpy.array
+        daily values without gaps in the dates
+    windows: list
+        window lengths in days
+
+    Returns
+    -------
+    numpy.array
+        array of shape (window,day)
+    """
+    values = np.asarray(values,dtype=float)
+    n = len(values)
+    missing = np.isnan(values)
+    total = np.concatenate(([0.],np.cumsum(np.where(missing,0,values))))
+    gaps = np.concatenate(([0],np.cumsum(missing)))
+    out = np.full((len(windows),n),np.nan)
+    for i,w in enumerate(windows):
+        # the window of day d is d-w//2 ... d-w//2+w-1, as in pandas
+        first = np.arange(n) - w//2
+        full = (first>=0) & (first+w<=n)
+        start, stop = first[full], first[full]+w
+        mean = (total[stop] - total[start])/w
+        mean[gaps[stop] - gaps[start] > 0] = np.nan
+        out[i,full] = mean
+    return out
+
+def maArrays(data,variable,years=30,endYear=2012,averages=["5day","10day","30day"],
+             catchments=None,dropLeapDay=True,out=None):
+    """
+    Computes the moving averages of all catchments of a region into (doy,year,catchment) arrays.
+
+    Parameters
+    ----------
+    data: dictionary
+        organised data of a region, e.g. from the data store or sorlandet_final.pkl
+    variable: str
+        {"streamflow","rainfall","snowmelt","temperature"}
+    years: int
+        number of years in period, ending in endYear
+    endYear: int
+    averages: list
+    catchments: list
+        catchments in this order, default is the final selection for the period,
+        as in the arrays of reshapeToArray.reshapeArrays
+    dropLeapDay: bool
+        see reshapeToArray.dayIndex
+    out: dictionary
+        preallocated arrays of shape (365,years,catchment) by MA, e.g. memory-mapped files
+
+    Returns
+    -------
+    dictionary
+        arrays of shape (365,years,catchment) by MA
+    """
+    period = np.arange(endYear+1-int(years),endYear+1)
+    if catchments is None:
+        catchments = list(data[f"final{years}"])
+    if out is None:
+        out = {MA:np.empty((365,len(period),len(catchments))) for MA in averages}
+    windows = [WINDOWS[MA] for MA in averages]
+    for c in range(len(catchments)):
+        ts = dailySeries(data,variable,catchments[c])
+        # moving averages need consecutive days
+        ts = ts.reindex(pd.date_range(ts.index.min(),ts.index.max()))
+        means = centredMeans(ts.values,windows)
+        doy, year, keep = dayIndex(ts.index,period,dropLeapDay=dropLeapDay)
+        for i,MA in enumerate(averages):
+            out[MA][:,:,c] = np.nan
+            out[MA][doy[keep],year[keep],c] = means[i,keep]
+    return out
+
+def writeMAArrays(data,variable,region,years=30,endYear=2012,averages=["5day","10day","30day"],
+                  outDir="Reshaped",dropLeapDay=True,compact=False):
+    """
+    Writes the moving average arrays of a region to the .npy files read by the field
+    significance, {outDir}/{variable}_{region}_{MA}_{years}year.npy.
+
+    The files are written memory-mapped, one catchment at a time. As in the arrays
+    of reshapeToArray.reshapeArrays, the catchments are the final selection for the
+    period and the DOYs are laid out by reshapeToArray.dayIndex. With compact=True
+    the files are float32 with a validity mask, see compactCube.py.
+    """
+    catchments = list(data[f"final{years}"])
+    files = {MA:f"{outDir}/{variable}_{region}_{MA}_{years}year.npy" for MA in averages}
+    out = {MA:open_memmap(files[MA],mode="w+",dtype=np.float32 if compact else float,
+                          shape=(365,int(years),len(catchments))) for MA in averages}
+    maArrays(data,variable,years=years,endYear=endYear,averages=averages,
+             catchments=catchments,dropLeapDay=dropLeapDay,out=out)
+    for MA in averages:
+        out[MA].flush()
+        if compact:
+            compactCube.saveMask(files[MA],compactCube.validity(out[MA]))
+    print(f"{variable} {region} {years} years written.")
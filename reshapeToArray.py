@@ -1,6 +1,10 @@
 import numpy as np
 import pandas as pd
 import pickle
+import time
+from pathlib import Path
+from instrumentation import stage
+import compactCube
 
 def saveDict(dictionary,filename):
     """
@@ -37,7 +41,71 @@ def openDict(filename):
     loadedDict = pickle.load(pickle_in)
     return loadedDict
 
-def reshapeToArray(data,MA,period=30):
+def dayIndex(dates,years,dropLeapDay=True):
+    """
+    DOY and year position of each date in the (doy,year) layout.
+    
+    All reshaped arrays, from reshapeToArray, the data store and
+    movingAverages.py, are laid out with this function.
+    
+    Parameters
+    ----------
+    dates: pandas.DatetimeIndex
+    years: numpy.array
+        consecutive years of the period
+    dropLeapDay: bool
+        leave out 29 February, so that every DOY is the same calendar day in
+        all years, else leave out 31 December in leap years as the original
+        element-wise reshaping did
+    
+    Returns
+    -------
+    tuple of numpy.array
+        doy and year index, and a mask of the dates that are kept
+    """
+    doy = np.asarray(dates.dayofyear) - 1
+    if dropLeapDay:
+        leap = np.asarray(dates.is_leap_year)
+        doy = doy - (leap & (doy>=59))
+        keep = ~(leap & (np.asarray(dates.month)==2) & (np.asarray(dates.day)==29))
+    else:
+        keep = doy < 365
+    year = np.asarray(dates.year) - years[0]
+    keep &= (year>=0) & (year<len(years))
+    return doy, year, keep
+
+def catchmentArray(series,years,dropLeapDay=True):
+    """
+    Arranges the moving average series of one catchment by day of year and year.
+    
+    Parameters
+    ----------
+    series: pandas.Series or dictionary
+        series with datetime index, or dictionary of yearly series keyed by year string
+    years: numpy.array
+        consecutive years to include
+    dropLeapDay: bool
+        see dayIndex
+    
+    Returns
+    -------
+    numpy.array
+        array of shape (doy,year)
+    """
+    if isinstance(series,pd.Series) and isinstance(series.index,pd.DatetimeIndex):
+        doy, year, keep = dayIndex(series.index,years,dropLeapDay=dropLeapDay)
+        arr = np.full((365,len(years)),np.nan)
+        arr[doy[keep],year[keep]] = np.asarray(series,dtype=float)[keep]
+        return arr
+    arr = np.full((365,len(years)),np.nan)
+    for i,y in enumerate(years):
+        values = np.asarray(series[f"{y}"],dtype=float)
+        if dropLeapDay and len(values) == 366:
+            values = np.delete(values,59)
+        arr[:,i] = values[:365]
+    return arr
+
+def reshapeToArray(data,MA,period=30,catchments=None,fill=-99,verbose=False,endYear=2012,dtype=float,dropLeapDay=True):
     """
     Reshapes moving average smoothed data from dictionary to array.
     
@@ -47,42 +115,187 @@ def reshapeToArray(data,MA,period=30):
         for a certain region, containing 30 year timeseries for different moving averages
     MA: str
         {"5day","10day","30day"}
+    period: int
+        number of years in period, ending in endYear
+    catchments: list
+        catchments to include in this order, default is all catchments in data
+    fill: float
+        value for catchments in the list that are missing in data,
+        e.g. catchments in the 30 year selection without 50 years of data
+    verbose: bool
+        print the time used for reshaping
+    endYear: int
+        last year of the period
+    dtype: numpy.dtype
+        float for the arrays saved by default, float32 for compact cubes
+    dropLeapDay: bool
+        see dayIndex
     
     Returns
     -------
     numpy.array
         array of shape (doy,year,catchment) with the catchments ordered by altitude
     """
-    doy = np.arange(365)
-    start = 2013-int(period)
-    years = np.arange(start,2013)
-    catchments = list(data.keys())
-    x = len(catchments)
+    t0 = time.perf_counter()
+    years = np.arange(endYear+1-int(period),endYear+1)
+    if catchments is None:
+        catchments = list(data.keys())
     # array with shape: doy,year,catchment
-    arr = np.full((len(doy),len(years),x),np.nan)
+    arr = np.full((365,len(years),len(catchments)),np.nan,dtype=dtype)
     # filling array
-    for c in range(x):
-        for y in years:
-            for d in doy:
-                arr[d,y-start,c] = data[catchments[c]][MA][f"{y}"][d]
+    with stage("reshape"):
+        for c in range(len(catchments)):
+            if catchments[c] in data:
+                arr[:,:,c] = catchmentArray(data[catchments[c]][MA],years,dropLeapDay=dropLeapDay)
+            else:
+                arr[:,:,c] = fill
+    if verbose:
+        print(f"\tReshaped {MA} for {len(catchments)} catchments in {time.perf_counter()-t0:.2f} s")
     return(arr)
 
-file = input("Pickle file without extention:")
-var = input("Variable:")
-years = input("Number of years in period:")
-years = int(years)
-MA = input("If you wish to reshape only one MA please type the number of days, e.g. '5day', else press enter:")
-if MA == "":
-    averages = ["5day","10day","30day"]
-else:
-    averages = [MA]
+def reshapeArrays(data,var,years,averages=["5day","10day","30day"],regions=None,outDir="Reshaped",endYear=2012,compact=False,
+                  dropLeapDay=True):
+    """
+    Reshapes all regions and moving averages of a variable and saves them to .npy files.
+    
+    Parameters
+    ----------
+    data: dictionary or str
+        moving average dictionary, or the name of a variable in the data store
+    var: str
+        variable name used in the output filenames
+    years: int
+        number of years in period
+    averages: list
+    regions: list
+        regions to reshape, default is all regions in data
+    outDir: str
+    endYear: int
+        last year of the period
+    compact: bool
+        save float32 arrays with a validity mask instead of -99 for missing
+        catchments, see compactCube.py
+    dropLeapDay: bool
+        see dayIndex, the data store is laid out when it is written
+    """
+    # imported here, as dataStore itself imports from this module
+    import dataStore
+    
+    if regions is None:
+        if isinstance(data,str):
+            regions = dataStore.regions(data,period=years)
+        else:
+            regions = list(data.keys())
+    
+    for region in regions:
+        print(f"\nAnalysing {region}:")
+        for MA in averages:
+            if isinstance(data,str):
+                array = dataStore.loadMA(data,region,MA,period=years,endYear=endYear,dtype=np.float32 if compact else float)
+            else:
+                array = reshapeToArray(data[region],MA,period=years,verbose=True,endYear=endYear,
+                                       dtype=np.float32 if compact else float,dropLeapDay=dropLeapDay)
+            if compact:
+                compactCube.save(f"{outDir}/{var}_{region}_{MA}_{years}year.npy",*compactCube.compress(array))
+            else:
+                np.save(f"{outDir}/{var}_{region}_{MA}_{years}year",array)
+            print(f"{MA} finshed.")
+
+def regionCube(arrays):
+    """
+    Joins the reshaped arrays of several regions into one cube, so that all
+    catchments are analysed in one call.
+    
+    Parameters
+    ----------
+    arrays: dictionary
+        arrays of shape (doy,year,catchment) by region, may be memory-mapped
+    
+    Returns
+    -------
+    tuple
+        array of shape (doy,year,catchment) with the catchments of all regions in
+        order, and the region of each catchment
+    """
+    regions = list(arrays.keys())
+    cube = np.concatenate([np.asarray(arrays[region]) for region in regions],axis=2)
+    labels = np.concatenate([np.full(arrays[region].shape[2],region) for region in regions])
+    return cube, labels
 
-data = openDict(file)
+def rollArray(array,values):
+    """
+    Moves the period of a reshaped array on by one year.
+    
+    Parameters
+    ----------
+    array: numpy.array
+        array of shape (doy,year,catchment)
+    values: numpy.array
+        the new year, shape (doy,catchment)
+    
+    Returns
+    -------
+    numpy.array
+        array of the same shape without the first year and with values as the last year
+    """
+    return np.concatenate((array[:,1:],np.asarray(values,dtype=array.dtype)[:,None,:]),axis=1)
 
+def appendYear(data,var,years,year,averages=["5day","10day","30day"],regions=None,outDir="Reshaped",fill=-99,dropLeapDay=True):
+    """
+    Moves the period of the reshaped arrays saved by reshapeArrays on to end in year,
+    reshaping only the new year instead of the whole period.
+    
+    Parameters
+    ----------
+    data: dictionary
+        moving average dictionary containing at least the new year, with the
+        catchments of each region in the same order as when the arrays were reshaped
+    var: str
+    years: int
+        number of years in period
+    year: int
+        the new year, the year after the last year of the saved arrays
+    averages: list
+    regions: list
+        regions to update, default is all regions in data
+    outDir: str
+    fill: float
+        value for catchments filled with fill in the saved array, compact cubes
+        use their validity mask instead
+    dropLeapDay: bool
+        see dayIndex, as when the arrays were reshaped
+    """
+    if regions is None:
+        regions = list(data.keys())
+    for region in regions:
+        catchments = list(data[region].keys())
+        for MA in averages:
+            file = f"{outDir}/{var}_{region}_{MA}_{years}year.npy"
+            array, valid = compactCube.load(file,mmap_mode=None)
+            values = np.full((365,len(catchments)),np.nan)
+            for c in range(len(catchments)):
+                values[:,c] = catchmentArray(data[region][catchments[c]][MA],np.array([year]),dropLeapDay=dropLeapDay)[:,0]
+            # catchments missing from the period stay missing
+            missing = compactCube.missing(array,valid,fill=fill)
+            values[:,missing] = np.nan if valid is not None else fill
+            np.save(file,rollArray(array,values))
+            if valid is not None:
+                compactCube.saveMask(file,np.column_stack((valid[:,1:],compactCube.validity(values[:,None,:]))))
+        print(f"{region} moved on to {year}.")
 
-for region in data.keys():
-    print(f"\nAnalysing {region}:")
-    for MA in averages:
-        array = reshapeToArray(data[region],MA,period=years)
-        np.save(f"Reshaped/{var}_{region}_{MA}_{years}year",array)
-        print(f"{MA} finshed.")
+if __name__ == "__main__":
+    file = input("Pickle file without extention, or variable name in the data store:")
+    var = input("Variable:")
+    years = input("Number of years in period:")
+    years = int(years)
+    MA = input("If you wish to reshape only one MA please type the number of days, e.g. '5day', else press enter:")
+    if MA == "":
+        averages = ["5day","10day","30day"]
+    else:
+        averages = [MA]
+    
+    if Path(f"{file}.pkl").exists():
+        data = openDict(file)
+    else:
+        data = file
+    reshapeArrays(data,var,years,averages)
@@ -0,0 +1,212 @@
+"""
+    Content-addressed cache of trend and field significance results.
+
+    A result is stored under a key that is the hash of the input array and all
+    parameters of the analysis, so a result is only reused when neither the data
+    nor the parameters changed. The cache directory contains one pickle file per
+    result, <key>.pkl, and manifest.json, which records the label and parameters
+    of each result. The last use of a result is the modification time of its
+    file, so loading a result does not write the manifest. When the cache grows
+    beyond its size limit, the least recently used results are removed.
+
+    Several processes can share a cache: files are written to unique temporary
+    names and moved into place, and the manifest is only changed under a lock.
+    """
+
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import time
+import numpy as np
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+CACHE = "Results/cache"
+MAXSIZE = 2**31
+
+def arrayKey(array,chunk=30,valid=None,**params):
+    """
+    Hashes an array together with the parameters of an analysis.
+
+    Parameters
+    ----------
+    array: numpy.array
+        input array, may be memory-mapped, it is read chunk rows at a time
+    chunk: int
+        number of rows along the first axis hashed at a time
+    valid: numpy.array
+        validity mask of a compact cube, see compactCube.py, hashed with the array
+    params:
+        parameters of the analysis, e.g. stage, alpha, q, NS, seed
+
+    Returns
+    -------
+    str
+        hexadecimal key
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps({"shape":list(array.shape),"dtype":array.dtype.str,**params},
+                        sort_keys=True,default=str).encode())
+    for i in range(0,array.shape[0],chunk):
+        h.update(np.ascontiguousarray(array[i:i+chunk]).tobytes())
+    if valid is not None:
+        h.update(f"valid{list(valid.shape)}".encode()+np.packbits(valid).tobytes())
+    return h.hexdigest()
+
+@contextmanager
+def _lock(root):
+    """
+    Holds an exclusive lock on the manifest of a cache directory.
+    """
+    with open(Path(root)/"manifest.lock","a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f,fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(),msvcrt.LK_LOCK,1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f,fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(),msvcrt.LK_UNLCK,1)
+
+def _replace(file,write,mode="w"):
+    """
+    Writes file through a uniquely named temporary file in the same directory.
+    """
+    with tempfile.NamedTemporaryFile(mode,dir=file.parent,prefix=f"{file.name}.",suffix=".tmp",delete=False) as f:
+        write(f)
+    os.replace(f.name,file)
+
+def _readManifest(root):
+    file = Path(root)/"manifest.json"
+    if not file.exists():
+        return {}
+    with open(file) as f:
+        return json.load(f)
+
+def _writeManifest(root,manifest):
+    _replace(Path(root)/"manifest.json",lambda f: json.dump(manifest,f,indent=1))
+
+def load(key,root=CACHE):
+    """
+    Loads a cached result and marks it as used by touching its file.
+
+    Returns
+    -------
+    the cached result, or None if there is no result for key
+    """
+    file = Path(root)/f"{key}.pkl"
+    try:
+        with open(file,"rb") as f:
+            result = pickle.load(f)
+        os.utime(file)
+    except FileNotFoundError:
+        # not cached, or evicted by another process
+        return None
+    return result
+
+def save(key,result,root=CACHE,maxSize=MAXSIZE,label=None,params=None):
+    """
+    Saves a result to the cache and removes the least recently used results
+    if the cache is larger than maxSize.
+
+    Parameters
+    ----------
+    key: str
+        key from arrayKey
+    result: object
+        numpy.array, pandas.DataFrame or dictionary to cache
+    root: str
+        cache directory
+    maxSize: int
+        size limit of the cache in bytes, None for no limit
+    label: str
+        readable name of the result recorded in the manifest, e.g. the output file
+    params: dictionary
+        parameters recorded in the manifest
+    """
+    Path(root).mkdir(parents=True,exist_ok=True)
+    file = Path(root)/f"{key}.pkl"
+    _replace(file,lambda f: pickle.dump(result,f),mode="wb")
+    with _lock(root):
+        manifest = _readManifest(root)
+        manifest[key] = {"file":file.name,
+                         "size":file.stat().st_size,
+                         "created":time.time(),
+                         "label":label,
+                         "params":params or {}}
+        if maxSize is not None:
+            evict(manifest,root,maxSize,keep=key)
+        _writeManifest(root,manifest)
+
+def evict(manifest,root,maxSize,keep=None):
+    """
+    Removes least recently used results from the cache directory, and their
+    entries from the manifest, until the cache is at most maxSize bytes.
+
+    All result files in the directory count, including those without a
+    manifest entry. Called by save with the manifest locked.
+    """
+    files = []
+    for file in Path(root).glob("*.pkl"):
+        try:
+            stat = file.stat()
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime,stat.st_size,file))
+    total = sum(size for used,size,file in files)
+    for used,size,file in sorted(files):
+        if total <= maxSize:
+            break
+        if file.stem == keep:
+            continue
+        total -= size
+        file.unlink(missing_ok=True)
+        manifest.pop(file.stem,None)
+
+def cached(array,compute,label=None,root=CACHE,maxSize=MAXSIZE,valid=None,**params):
+    """
+    Returns the cached result of compute for array and params, computing and
+    caching it if there is none. No caching if root is None.
+
+    Parameters
+    ----------
+    array: numpy.array
+        input array of the analysis
+    compute: function
+        called without arguments to compute the result
+    label: str
+    root: str
+    maxSize: int
+    valid: numpy.array
+        validity mask of a compact cube, part of the key
+    params:
+        all parameters that change the result
+
+    Returns
+    -------
+    result
+    """
+    if root is None:
+        return compute()
+    key = arrayKey(array,valid=valid,**params)
+    result = load(key,root=root)
+    if result is None:
+        result = compute()
+        save(key,result,root=root,maxSize=maxSize,label=label,params=params)
+    else:
+        print(f"\tUsing cached result for {label}")
+    return result
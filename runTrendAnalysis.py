@@ -1,12 +1,14 @@
 import numpy as np
-import pandas as pd
 from trendmaster import trend
 import pickle
 from statsmodels.tsa import stattools
-
-varDict = input("Pickle dictionary filename (with .pkl extention):")
-name = input("Variable name:")
-period = input("Number of years in period:")
+import batchTrend
+from reshapeToArray import reshapeToArray, regionCube
+import dataStore
+import resultCache
+import kernels
+import compactCube
+from instrumentation import peakRSS, stage, Progress
 
 def openDict(filename):
     """
@@ -25,51 +27,19 @@ def openDict(filename):
     loadedDict = pickle.load(pickle_in)
     return loadedDict
 
-final = openDict("finalSelectionList.pkl")
-
-def reshapeToArray(data,MA,fullList):
+def loadSelection():
     """
-        Reshapes moving average smoothed data from dictionary to array.
-        
-        Parameters
-        ----------
-        data: dictionary
-            for a certain region, containing 30 year timeseries for different moving averages
-        MA: str
-            {"5day","10day","30day"}
-        
-        Returns
-        -------
-        numpy.array
-            array of shape (doy,year,catchment) with the catchments ordered by altitude
-        """
-    doy = np.arange(365)
-    start = 2013-int(period)
-    years = np.arange(start,2013)
-    catchments = list(data.keys())
-    x = len(fullList)
-    # array with shape: doy,year,catchment
-    arr = np.full((len(doy),len(years),x),np.nan)
+    Loads the final selection of catchments, from the data store if it exists,
+    else from finalSelectionList.pkl.
     
-    if period == "30":
-        # filling array
-        for c in range(x):
-            for y in years:
-                for d in doy:
-                    arr[d,y-start,c] = data[fullList[c]][MA][f"{y}"][d]
-    
-    if period == "50":
-        # filling array
-        for c in range(x):
-            if fullList[c] in catchments:
-                for y in years:
-                    for d in doy:
-                        arr[d,y-start,c] = data[fullList[c]][MA][f"{y}"][d]
-            else:
-                for y in years:
-                    for d in doy:
-                        arr[d,y-start,c] = -99
-    return(arr)
+    Returns
+    -------
+    dictionary
+        {region:{30:[catchments],50:[catchments]}}
+    """
+    if dataStore.exists():
+        return dataStore.loadSelection()
+    return openDict("finalSelectionList.pkl")
 
 def autocorrTest(ts,alpha=0.05):
     """
@@ -94,53 +64,223 @@ def prewhiten(ts):
             pw[i] = (ts[i] - r*ts[i-1])/(1 - r)
     return pw
 
-def trendMagnitude(array,alpha=0.1):
+def trendMagnitude(array,alpha=0.1,backend="numpy",maxMemory=2**28,chunk=None,valid=None):
     """
         Calculated the trend magnitude for each doy if a significant trend is detected
         
         Parameters
         ----------
         array: numpy.array
-        array of shape: (doy,year,catchment) containing data to be analysed
+        array of shape: (doy,year,catchment) containing data to be analysed, may be memory-mapped
+        backend: str
+        {"numpy","numba","trend","auto"}, "numpy" runs the autocorrelation test, prewhitening and Mann-Kendall
+        test for all series in one call, "numba" runs the compiled kernels of kernels.py, "trend" calls
+        statsmodels and trend.mann_kendall for each series and is the reference
+        maxMemory: int
+        memory budget in bytes for the pairwise slopes of the "numpy" backend
+        chunk: int
+        number of doys the "numpy" backend reads and analyses at a time, default is all doys
+        valid: numpy.array
+        validity mask of a compact cube, shape: (catchment,year), see compactCube.py
         
         Returns
         -------
         numpy.array
         array of trend magnitude, shape: (catchments,doy)
         """
-    output = []
+    backend = kernels.resolve(backend)
+    if backend in ("numpy","numba"):
+        bundle = batchTrend.trendBundle(array,alpha=alpha,maxMemory=maxMemory,chunk=chunk,backend=backend,valid=valid)
+        return bundle["significantSlope"]
+    missing = compactCube.missing(array,valid)
+    p = np.full((array.shape[0],array.shape[2]),np.nan)
+    slope = np.full((array.shape[0],array.shape[2]),np.nan)
     for c in range(array.shape[2]):
-        arr = array[:,:,c] # slicing array by catchment
-        if (arr==-99).all():
-            out = np.full(arr.shape[0],-99)
-        else:
-            out = np.full(arr.shape[0],np.nan) # create empty array
-            for day in range(arr.shape[0]):
-                ts = arr[day,:]
-                if autocorrTest(ts):
-                    ts = prewhiten(ts)
-                p = trend.mann_kendall(ts) #calculate p-value
-                if p < alpha: #calculate trend magnitude if significant trend is detected
-                    out[day] = trend.sen_slope(ts)
-        output.append(out)
-    return np.array(output)
+        if missing[c]:
+            continue
+        for day in range(array.shape[0]):
+            ts = np.asarray(array[day,:,c],dtype=float)
+            if autocorrTest(ts):
+                ts = prewhiten(ts)
+            p[day,c] = trend.mann_kendall(ts)
+            if p[day,c] < alpha:
+                slope[day,c] = trend.sen_slope(ts)
+    
+    # trend magnitude only where a significant trend is detected
+    output = np.where(p<alpha,slope,np.nan).T
+    output[missing,:] = -99
+    return output
 
-def trendArrays(varDict,variable=name,averages=["5day","10day","30day"]):
+def loadArray(varDict,region,MA,period,final,endYear=2012,compact=False):
+    """
+    Loads the (doy,year,catchment) array of the selected catchments of a region,
+    from a moving average dictionary or from the data store.
+    
+    Returns
+    -------
+    tuple
+        array with -99 for selected catchments missing from the data, and None;
+        if compact a float32 array with NaN instead and its validity mask, built
+        from the selection and the catchments in the data, see compactCube.selectionMask
+    """
+    catchments = final[region][30]
+    fill, dtype = (np.nan,np.float32) if compact else (-99,float)
+    if isinstance(varDict,str):
+        with stage("load"):
+            array = dataStore.loadMA(varDict,region,MA,period=period,catchments=catchments,fill=fill,endYear=endYear,dtype=dtype)
+        available = dataStore.catchments(varDict,region,period=period)
+    else:
+        array = reshapeToArray(varDict[region],MA,period=period,catchments=catchments,fill=fill,verbose=True,endYear=endYear,
+                               dtype=dtype)
+        available = varDict[region].keys()
+    if not compact:
+        return array, None
+    return array, compactCube.selectionMask(catchments,available,array.shape[1])
+
+def trendArrays(varDict,variable,period,final,averages=["5day","10day","30day"],regions=None,alpha=0.1,resultDir="Results",cacheDir=resultCache.CACHE,endYear=2012,backend="numpy",compact=False):
     """
     Calculates trend arrays and saves them to .npy file in "Results" folder.
+    
+    Parameters
+    ----------
+    varDict: dictionary or str
+        moving average dictionary, or the name of a variable in the data store,
+        which is then loaded one region and MA at a time
+    variable: str
+        variable name used in the output filenames
+    period: int
+        number of years in period
+    final: dictionary
+        final selection of catchments, {region:{30:[catchments],50:[catchments]}}
+    averages: list
+    regions: list
+        regions to analyse, default is all regions in varDict
+    alpha: float
+        significance level
+    resultDir: str
+    cacheDir: str
+        result cache, a region and MA is only analysed again if its array or
+        the parameters changed, None to always analyse
+    endYear: int
+        last year of the period
+    backend: str
+        backend of trendMagnitude, {"numpy","numba","trend","auto"}
+    compact: bool
+        analyse float32 arrays with a validity mask instead of -99 for missing
+        catchments and save float32 results, see compactCube.py
     """
-    for region in varDict.keys():
+    if regions is None:
+        if isinstance(varDict,str):
+            regions = dataStore.regions(varDict,period=period)
+        else:
+            regions = list(varDict.keys())
+    progress = Progress(len(regions)*len(averages),f"{variable} arrays analysed")
+    for region in regions:
+        print("-------------------------")
+        print(f"Analysing region {region}.")
+        for MA in averages:
+            array, valid = loadArray(varDict,region,MA,period,final,endYear=endYear,compact=compact)
+            name = f"trendAnalysis_{variable}_{region}_{MA}_{period}years"
+            result = resultCache.cached(array,lambda: trendMagnitude(array,alpha=alpha,backend=backend,valid=valid),label=name,
+                                        root=cacheDir,valid=valid,stage="trendAnalysis",alpha=alpha,prewhitening=batchTrend.PREWHITENING,
+                                        backend=kernels.resolve(backend))
+            with stage("write"):
+                np.save(f"{resultDir}/{name}",result.astype(np.float32) if compact else result)
+            print(f"\t{MA} completed.")
+            progress.update()
+        print(f"Region {region} complete. Peak memory use: {peakRSS():.0f} MB")
+    print("-------------------------")
+    print("Trend analysis complete.")
+    print("-------------------------")
+
+def trendBundles(varDict,variable,period,final,averages=["5day","10day","30day"],regions=None,alpha=0.1,resultDir="Results",cacheDir=resultCache.CACHE,endYear=2012,backend="numpy",compact=False):
+    """
+    Runs the trend analysis once per region and MA and saves all results of the pass:
+    the p-values, S, trend magnitude, significant trend magnitude and prewhitening mask
+    to trendBundle_<variable>_<region>_<MA>_<period>years.npz, and the significant and
+    unmasked trend magnitude to the trendAnalysis_ and trendMagnitude_ .npy files
+    otherwise written by runTrendAnalysis.py and runTrendMagnitude.py.
+    
+    Parameters are the same as for trendArrays.
+    """
+    if regions is None:
+        if isinstance(varDict,str):
+            regions = dataStore.regions(varDict,period=period)
+        else:
+            regions = list(varDict.keys())
+    progress = Progress(len(regions)*len(averages),f"{variable} arrays analysed")
+    for region in regions:
         print("-------------------------")
         print(f"Analysing region {region}.")
         for MA in averages:
-            array = reshapeToArray(varDict[region],MA,final[region][30])
-            result = trendMagnitude(array)
-            np.save(f"Results/trendAnalysis_{variable}_{region}_{MA}_{period}years",result)
+            array, valid = loadArray(varDict,region,MA,period,final,endYear=endYear,compact=compact)
+            name = f"{variable}_{region}_{MA}_{period}years"
+            bundle = resultCache.cached(array,lambda: batchTrend.trendBundle(array,alpha=alpha,backend=backend,valid=valid),
+                                        label=f"trendBundle_{name}",root=cacheDir,valid=valid,stage="trendBundle",alpha=alpha,
+                                        prewhitening=batchTrend.PREWHITENING,backend=kernels.resolve(backend))
+            saveBundle(bundle,name,alpha,resultDir=resultDir,compact=compact)
             print(f"\t{MA} completed.")
-        print(f"Region {region} complete.")
+            progress.update()
+        print(f"Region {region} complete. Peak memory use: {peakRSS():.0f} MB")
     print("-------------------------")
     print("Trend analysis complete.")
     print("-------------------------")
 
-df = openDict(varDict) #open dictionary with data from spesific varaible
-trendArrays(df) #analyse trends for all regions
+def saveBundle(bundle,name,alpha,resultDir="Results",compact=False,**extra):
+    """
+    Saves a trend bundle to trendBundle_<name>.npz and its significant and
+    unmasked trend magnitude to trendAnalysis_<name>.npy and trendMagnitude_<name>.npy,
+    as float32 if compact. extra arrays are only saved to the .npz file.
+    """
+    if compact:
+        bundle = {k:v.astype(np.float32) if v.dtype == float else v for k,v in bundle.items()}
+    with stage("write"):
+        np.savez(f"{resultDir}/trendBundle_{name}",alpha=alpha,**bundle,**extra)
+        np.save(f"{resultDir}/trendAnalysis_{name}",bundle["significantSlope"])
+        np.save(f"{resultDir}/trendMagnitude_{name}",bundle["slope"])
+
+def nationalBundles(varDict,variable,period,final,averages=["5day","10day","30day"],regions=None,alpha=0.1,resultDir="Results",cacheDir=resultCache.CACHE,endYear=2012,backend="numpy",compact=False,national="norway"):
+    """
+    Runs the trend analysis of all regions as one cube per MA, see reshapeToArray.regionCube,
+    instead of one array per region.
+    
+    The results are split by region and saved to the same files as by trendBundles,
+    and for all catchments to trendBundle_<variable>_<national>_<MA>_<period>years.npz,
+    which also holds the region of each catchment as "region".
+    
+    Parameters are the same as for trendArrays, national is the name of the whole cube in the filenames.
+    """
+    if regions is None:
+        if isinstance(varDict,str):
+            regions = dataStore.regions(varDict,period=period)
+        else:
+            regions = list(varDict.keys())
+    progress = Progress(len(averages),f"{variable} cubes analysed")
+    for MA in averages:
+        loaded = {region:loadArray(varDict,region,MA,period,final,endYear=endYear,compact=compact) for region in regions}
+        cube, labels = regionCube({region:array for region,(array,valid) in loaded.items()})
+        valid = np.concatenate([valid for array,valid in loaded.values()]) if compact else None
+        bundle = resultCache.cached(cube,lambda: batchTrend.trendBundle(cube,alpha=alpha,backend=backend,valid=valid),
+                                    label=f"trendBundle_{variable}_{national}_{MA}_{period}years",root=cacheDir,valid=valid,
+                                    stage="trendBundle",alpha=alpha,prewhitening=batchTrend.PREWHITENING,backend=kernels.resolve(backend))
+        for region in regions:
+            saveBundle({k:v[labels==region] for k,v in bundle.items()},f"{variable}_{region}_{MA}_{period}years",
+                       alpha,resultDir=resultDir,compact=compact)
+        saveBundle(bundle,f"{variable}_{national}_{MA}_{period}years",alpha,resultDir=resultDir,compact=compact,region=labels)
+        print(f"{MA} completed for {len(labels)} catchments. Peak memory use: {peakRSS():.0f} MB")
+        progress.update()
+    print("-------------------------")
+    print("Trend analysis complete.")
+    print("-------------------------")
+
+if __name__ == "__main__":
+    varDict = input("Pickle dictionary filename (with .pkl extention), or variable name in the data store:")
+    name = input("Variable name:")
+    period = input("Number of years in period:")
+    
+    final = loadSelection()
+    if varDict.endswith(".pkl"):
+        df = openDict(varDict) #open dictionary with data from spesific varaible
+    else:
+        df = varDict #variable is read from the data store region by region
+    trendArrays(df,name,period,final) #analyse trends for all regions
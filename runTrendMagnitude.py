@@ -1,12 +1,14 @@
 import numpy as np
-import pandas as pd
 from trendmaster import trend
 import pickle
 from statsmodels.tsa import stattools
-
-varDict = input("Pickle dictionary filename (with .pkl extention):")
-name = input("Variable name:")
-period = input("Number of years in period:")
+import batchTrend
+from runTrendAnalysis import loadArray
+import dataStore
+import resultCache
+import kernels
+import compactCube
+from instrumentation import peakRSS, stage, Progress
 
 def openDict(filename):
     """
@@ -25,51 +27,19 @@ def openDict(filename):
     loadedDict = pickle.load(pickle_in)
     return loadedDict
 
-final = openDict("finalSelectionList.pkl")
-
-def reshapeToArray(data,MA,fullList):
+def loadSelection():
     """
-        Reshapes moving average smoothed data from dictionary to array.
-        
-        Parameters
-        ----------
-        data: dictionary
-        for a certain region, containing 30 year timeseries for different moving averages
-        MA: str
-        {"5day","10day","30day"}
+        Loads the final selection of catchments, from the data store if it exists,
+        else from finalSelectionList.pkl.
         
         Returns
         -------
-        numpy.array
-        array of shape (doy,year,catchment) with the catchments ordered by altitude
+        dictionary
+        {region:{30:[catchments],50:[catchments]}}
         """
-    doy = np.arange(365)
-    start = 2013-int(period)
-    years = np.arange(start,2013)
-    catchments = list(data.keys())
-    x = len(fullList)
-    # array with shape: doy,year,catchment
-    arr = np.full((len(doy),len(years),x),np.nan)
-    
-    if period == "30":
-        # filling array
-        for c in range(x):
-            for y in years:
-                for d in doy:
-                    arr[d,y-start,c] = data[fullList[c]][MA][f"{y}"][d]
-    
-    if period == "50":
-        # filling array
-        for c in range(x):
-            if fullList[c] in catchments:
-                for y in years:
-                    for d in doy:
-                        arr[d,y-start,c] = data[fullList[c]][MA][f"{y}"][d]
-            else:
-                for y in years:
-                    for d in doy:
-                        arr[d,y-start,c] = -99
-    return(arr)
+    if dataStore.exists():
+        return dataStore.loadSelection()
+    return openDict("finalSelectionList.pkl")
 
 def autocorrTest(ts,alpha=0.05):
     """
@@ -94,51 +64,120 @@ def prewhiten(ts):
             pw[i] = (ts[i] - r*ts[i-1])/(1 - r)
     return pw
 
-def trendMagnitude(array,alpha=0.1):
+def trendMagnitude(array,backend="numpy",maxMemory=2**28,chunk=None,valid=None):
     """
-        Calculated the trend magnitude for each doy if a significant trend is detected
+        Calculated the trend magnitude for each doy
         
         Parameters
         ----------
         array: numpy.array
-        array of shape: (doy,year,catchment) containing data to be analysed
+        array of shape: (doy,year,catchment) containing data to be analysed, may be memory-mapped
+        backend: str
+        {"numpy","numba","trend","auto"}, "numpy" runs the autocorrelation test, prewhitening and Sen's slope
+        for all series in one call, "numba" runs the compiled kernels of kernels.py, "trend" calls
+        statsmodels and trend.sen_slope for each series and is the reference
+        maxMemory: int
+        memory budget in bytes for the pairwise slopes of the "numpy" backend
+        chunk: int
+        number of doys the "numpy" backend reads and analyses at a time, default is all doys
+        valid: numpy.array
+        validity mask of a compact cube, shape: (catchment,year), see compactCube.py
         
         Returns
         -------
         numpy.array
         array of trend magnitude, shape: (catchments,doy)
         """
-    output = []
-    for c in range(array.shape[2]):
-        arr = array[:,:,c] # slicing array by catchment
-        if (arr==-99).all():
-            out = np.full(arr.shape[0],-99)
-        else:
-            out = np.full(arr.shape[0],np.nan) # create empty array
-            for day in range(arr.shape[0]):
-                ts = arr[day,:]
+    missing = compactCube.missing(array,valid)
+    slope = np.full((array.shape[0],array.shape[2]),np.nan)
+    backend = kernels.resolve(backend)
+    if backend == "numba":
+        step = array.shape[0] if chunk is None else chunk
+        for d in range(0,array.shape[0],step):
+            with stage("kernel"):
+                slope[d:d+step] = kernels.trendSeries(array[d:d+step])[2]
+    elif backend == "numpy":
+        step = array.shape[0] if chunk is None else chunk
+        for d in range(0,array.shape[0],step):
+            # autocorrelation testing and prewhitening of each series
+            series = batchTrend.prewhiten(array[d:d+step])[0]
+            # trend magnitude
+            slope[d:d+step] = batchTrend.senSlope(series,maxMemory=maxMemory)
+    elif backend == "trend":
+        for c in range(array.shape[2]):
+            if missing[c]:
+                continue
+            for day in range(array.shape[0]):
+                ts = np.asarray(array[day,:,c],dtype=float)
                 if autocorrTest(ts):
                     ts = prewhiten(ts)
-                out[day] = trend.sen_slope(ts)
-        output.append(out)
-    return np.array(output)
+                slope[day,c] = trend.sen_slope(ts)
+    
+    output = slope.T
+    output[missing,:] = -99
+    return output
 
-def trendArrays(varDict,variable=name,averages=["5day","10day","30day"]):
+def trendArrays(varDict,variable,period,final,averages=["5day","10day","30day"],regions=None,resultDir="Results",cacheDir=resultCache.CACHE,endYear=2012,backend="numpy",compact=False):
     """
         Calculates trend arrays and saves them to .npy file in "Results" folder.
+        
+        Parameters
+        ----------
+        varDict: dictionary or str
+        moving average dictionary, or the name of a variable in the data store,
+        which is then loaded one region and MA at a time
+        variable: str
+        variable name used in the output filenames
+        period: int
+        number of years in period
+        final: dictionary
+        final selection of catchments, {region:{30:[catchments],50:[catchments]}}
+        averages: list
+        regions: list
+        regions to analyse, default is all regions in varDict
+        resultDir: str
+        cacheDir: str
+        result cache, a region and MA is only analysed again if its array
+        changed, None to always analyse
+        endYear: int
+        last year of the period
+        backend: str
+        backend of trendMagnitude, {"numpy","numba","trend","auto"}
+        compact: bool
+        analyse float32 arrays with a validity mask and save float32 results, see compactCube.py
         """
-    for region in varDict.keys():
+    if regions is None:
+        if isinstance(varDict,str):
+            regions = dataStore.regions(varDict,period=period)
+        else:
+            regions = list(varDict.keys())
+    progress = Progress(len(regions)*len(averages),f"{variable} arrays analysed")
+    for region in regions:
         print("-------------------------")
         print(f"Analysing region {region}.")
         for MA in averages:
-            array = reshapeToArray(varDict[region],MA,final[region][30])
-            result = trendMagnitude(array)
-            np.save(f"Results/trendMagnitude_{variable}_{region}_{MA}_{period}years",result)
+            array, valid = loadArray(varDict,region,MA,period,final,endYear=endYear,compact=compact)
+            name = f"trendMagnitude_{variable}_{region}_{MA}_{period}years"
+            result = resultCache.cached(array,lambda: trendMagnitude(array,backend=backend,valid=valid),label=name,root=cacheDir,
+                                        valid=valid,stage="trendMagnitude",prewhitening=batchTrend.PREWHITENING,
+                                        backend=kernels.resolve(backend))
+            with stage("write"):
+                np.save(f"{resultDir}/{name}",result.astype(np.float32) if compact else result)
             print(f"\t{MA} completed.")
-        print(f"Region {region} complete.")
+            progress.update()
+        print(f"Region {region} complete. Peak memory use: {peakRSS():.0f} MB")
     print("-------------------------")
     print("Trend analysis complete.")
     print("-------------------------")
 
-df = openDict(varDict) #open dictionary with data from spesific varaible
-trendArrays(df) #analyse trends for all regions
+if __name__ == "__main__":
+    varDict = input("Pickle dictionary filename (with .pkl extention), or variable name in the data store:")
+    name = input("Variable name:")
+    period = input("Number of years in period:")
+    
+    final = loadSelection()
+    if varDict.endswith(".pkl"):
+        df = openDict(varDict) #open dictionary with data from spesific varaible
+    else:
+        df = varDict #variable is read from the data store region by region
+    trendArrays(df,name,period,final) #analyse trends for all regions
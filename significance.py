@@ -0,0 +1,202 @@
+"""
+    Significance of stored trend and field significance results at any level.
+
+    The trend bundles of runTrendAnalysis.trendBundles keep the Mann-Kendall
+    p-values, S statistics and Sen's slopes, and the field significance records
+    of dailyFieldSignificance.fieldSignRecord the p-values of the observed
+    series and of every bootstrap sample. Neither depends on a significance
+    level, so the significant trends and the field significance for another
+    alpha or percentile q are derived from them in milliseconds instead of
+    running the analysis again.
+
+    walker and falseDiscoveryRate test the field significance directly from
+    the p-values of the catchments, without resampling (Wilks, 2006,
+    https://doi.org/10.1175/JAM2404.1).
+    """
+
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+def suffix(alpha,q=None):
+    """
+    Filename suffix of results at a significance level, e.g. _a10 for alpha=0.1,
+    as in annualTrends_30years_a10.csv, and _a10_q90 with a percentile.
+    """
+    s = f"_a{100*alpha:g}"
+    if q is not None:
+        s += f"_q{q:g}"
+    return s
+
+def loadBundle(variable,region,MA,period,resultDir="Results"):
+    """
+    Loads a trend bundle saved by runTrendAnalysis.trendBundles.
+
+    Returns
+    -------
+    dictionary of numpy.array, see batchTrend.trendBundle
+    """
+    with np.load(f"{resultDir}/trendBundle_{variable}_{region}_{MA}_{period}years.npz") as f:
+        return {k:f[k] for k in f.files}
+
+def loadRecord(variable,region,MA,period,resultDir="Results/FS"):
+    """
+    Loads a field significance record saved by dailyFieldSignificance.fieldSignFiles.
+
+    Returns
+    -------
+    dictionary of numpy.array, see dailyFieldSignificance.fieldSignRecord
+    """
+    with np.load(f"{resultDir}/fieldSignRecord_{variable}_{region}_{MA}_{period}year.npz") as f:
+        return {k:f[k] for k in f.files}
+
+def significantSlope(bundle,alpha=0.1):
+    """
+    Trend magnitude where the trend is significant at alpha, as saved by runTrendAnalysis.py.
+
+    Parameters
+    ----------
+    bundle: dictionary
+        trend bundle with "pvalue" and "slope"
+    alpha: float
+
+    Returns
+    -------
+    numpy.array
+        Sen's slope where p < alpha, else NaN, -99 for missing catchments, shape: (catchments,doy)
+    """
+    out = np.where(bundle["pvalue"]<alpha,bundle["slope"],np.nan)
+    out[bundle["slope"]==-99] = -99
+    return out
+
+def fieldSignificance(pvalue,bootstrap,alpha=0.1,q=90):
+    """
+    Field significance after Burn and Hag Elnur, 2002, from stored p-values,
+    as returned by dailyFieldSignificance.fieldSignDaily for the same seed and NS.
+
+    Parameters
+    ----------
+    pvalue: numpy.array
+        p-values of the observed series, shape: (DOY,catchments)
+    bootstrap: numpy.array
+        p-values of the bootstrap samples, shape: (NS,DOY,catchments), NaN for
+        invalid samples
+    alpha: float
+        significance level of the trends
+    q: float
+        percentile of the bootstrap distribution used as critical value
+
+    Returns
+    -------
+    pandas.DataFrame with columns pcrit, percentSign and fieldSignificant, one row per DOY
+    """
+    catchments = pvalue.shape[-1]
+    percentSign = (pvalue<alpha).sum(axis=-1)/catchments
+    distribution = np.where(np.isnan(bootstrap[...,0]),np.nan,(bootstrap<alpha).sum(axis=-1)/catchments)
+    # NaN for DOYs with invalid samples
+    pcrit = np.percentile(distribution,q,axis=0)
+    return pd.DataFrame({"pcrit":pcrit,"percentSign":percentSign,"fieldSignificant":percentSign>pcrit})
+
+METHODS = ("bootstrap","fdr","walker")
+
+def walker(pvalue,level=0.1):
+    """
+    Walker's test: the field is significant if the smallest p-value is at most
+    1-(1-level)^(1/N), N the number of catchments.
+
+    Parameters
+    ----------
+    pvalue: numpy.array
+        p-values with the catchments along the last axis, NaN for catchments left out
+    level: float
+        global significance level
+
+    Returns
+    -------
+    tuple of numpy.array
+        critical p-value and field significance, with the catchment axis removed
+    """
+    n = np.isfinite(pvalue).sum(axis=-1)
+    with np.errstate(divide="ignore"):
+        pcrit = 1 - (1-level)**(1/n)
+    smallest = np.where(np.isnan(pvalue),np.inf,pvalue).min(axis=-1)
+    return pcrit, smallest <= pcrit
+
+def falseDiscoveryRate(pvalue,level=0.1):
+    """
+    Benjamini-Hochberg false discovery rate: the field is significant if the i-th
+    smallest of the N p-values is at most level*i/N for any i.
+
+    Parameters
+    ----------
+    pvalue: numpy.array
+        p-values with the catchments along the last axis, NaN for catchments left out
+    level: float
+        global significance level, the false discovery rate
+
+    Returns
+    -------
+    tuple of numpy.array
+        critical p-value, the largest p-value meeting its threshold (p_FDR in
+        Wilks, 2006), NaN where there is none, and field significance, with the
+        catchment axis removed
+    """
+    # NaN are sorted last
+    p = np.sort(pvalue,axis=-1)
+    n = np.isfinite(p).sum(axis=-1,keepdims=True)
+    below = p <= level*np.arange(1,p.shape[-1]+1)/n
+    pcrit = np.where(below,p,-np.inf).max(axis=-1)
+    significant = below.any(axis=-1)
+    return np.where(significant,pcrit,np.nan), significant
+
+def analyticFieldSignificance(pvalue,alpha=0.1,q=90,method="fdr"):
+    """
+    Field significance from the p-values of the catchments, without resampling.
+
+    The global significance level is 1-q/100, the level of the bootstrap with
+    the q-th percentile as critical value.
+
+    Parameters
+    ----------
+    pvalue: numpy.array
+        p-values with the catchments along the last axis, NaN for catchments
+        without data, which are left out of the test
+    alpha: float
+        significance level of the trends, for the proportion of significant catchments
+    q: float
+    method: str
+        {"fdr","walker"}
+
+    Returns
+    -------
+    tuple of numpy.array
+        critical p-value, proportion of catchments with p < alpha and field significance
+    """
+    if method == "fdr":
+        pcrit, significant = falseDiscoveryRate(pvalue,level=1-q/100)
+    elif method == "walker":
+        pcrit, significant = walker(pvalue,level=1-q/100)
+    else:
+        raise ValueError(f"Unknown method: {method}")
+    percentSign = (pvalue<alpha).sum(axis=-1)/pvalue.shape[-1]
+    return pcrit, percentSign, significant
+
+def thresholdFiles(variable,period,regions,averages=["5day","10day","30day"],alpha=0.1,q=90,
+                   resultDir="Results",fsDir="Results/FS"):
+    """
+    Writes the significant trend magnitude and the field significance at alpha and q
+    from the stored bundles and records, to trendAnalysis_..._a<alpha>.npy and
+    fieldSignificance_..._a<alpha>_q<q>.csv. Missing bundles or records are skipped.
+    """
+    for region in regions:
+        for MA in averages:
+            name = f"{variable}_{region}_{MA}_{period}"
+            if Path(f"{resultDir}/trendBundle_{name}years.npz").exists():
+                bundle = loadBundle(variable,region,MA,period,resultDir=resultDir)
+                np.save(f"{resultDir}/trendAnalysis_{name}years{suffix(alpha)}",significantSlope(bundle,alpha=alpha))
+                print(f"trendAnalysis_{name}years{suffix(alpha)} written.")
+            if Path(f"{fsDir}/fieldSignRecord_{name}year.npz").exists():
+                record = loadRecord(variable,region,MA,period,resultDir=fsDir)
+                fieldSignificance(record["pvalue"],record["bootstrap"],alpha=alpha,q=q).to_csv(
+                    f"{fsDir}/fieldSignificance_{name}year{suffix(alpha,q)}.csv")
+                print(f"fieldSignificance_{name}year{suffix(alpha,q)} written.")
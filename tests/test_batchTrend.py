@@ -0,0 +1,79 @@
+"""
+    Parity of the batched trend statistics of batchTrend.py with the per-series
+    functions of the USGS trend module.
+    """
+
+import numpy as np
+import pytest
+import batchTrend
+
+trend = pytest.importorskip("trendmaster.trend")
+
+def cube(years,catchments=4,seed=0,missing=0.05):
+    """
+    Synthetic (doy,year,catchment) cube with ties and missing values.
+    """
+    rng = np.random.default_rng(seed)
+    array = np.round(rng.gamma(2.,size=(365,years,catchments)) + 0.02*np.arange(years)[:,None],1)
+    array[rng.uniform(size=array.shape)<missing] = np.nan
+    return array
+
+def perSeries(f,array):
+    """
+    Applies a per-series function to every series along the year axis.
+    """
+    return np.array([[f(array[d,:,c]) for c in range(array.shape[2])] for d in range(array.shape[0])])
+
+@pytest.mark.parametrize("years",[30,50])
+def test_mkScore(years):
+    array = cube(years)
+    assert np.array_equal(batchTrend.mkScore(array),perSeries(trend.mk_score,array))
+
+@pytest.mark.parametrize("years",[30,50])
+def test_mkScoreVariance(years):
+    array = cube(years)
+    assert np.allclose(batchTrend.mkScoreVariance(array),perSeries(trend.mk_score_variance,array))
+
+@pytest.mark.parametrize("years",[30,50])
+def test_mannKendall(years):
+    array = cube(years)
+    p, s = batchTrend.mannKendall(array)
+    assert np.allclose(p,perSeries(trend.mann_kendall,array),rtol=0,atol=1e-12)
+    assert np.array_equal(s,perSeries(trend.mk_score,array))
+
+@pytest.mark.parametrize("years",[30,50])
+def test_senSlope(years):
+    array = cube(years,missing=0)
+    assert np.allclose(batchTrend.senSlope(array),perSeries(trend.sen_slope,array))
+
+def test_senSlopeMemory():
+    array = cube(30,missing=0)
+    # a budget of a few series at a time gives the same slopes
+    assert np.array_equal(batchTrend.senSlope(array,maxMemory=2**15),batchTrend.senSlope(array))
+
+def test_senSlopeMissing():
+    array = cube(30)
+    missing = np.isnan(array).any(axis=1)
+    slope = batchTrend.senSlope(array)
+    assert np.isnan(slope[missing]).all() and np.isfinite(slope[~missing]).all()
+
+@pytest.mark.parametrize("years",[30,50])
+def test_autocorrelation(years):
+    stattools = pytest.importorskip("statsmodels.tsa.stattools")
+    array = cube(years,missing=0)
+    r, p = batchTrend.autocorrelation(array)
+    acf = [[stattools.acf(array[d,:,c],qstat=True,nlags=1) for c in range(array.shape[2])] for d in range(array.shape[0])]
+    assert np.allclose(r,[[a[0][1] for a in row] for row in acf])
+    assert np.allclose(p,[[a[2][0] for a in row] for row in acf])
+
+@pytest.mark.parametrize("years",[30,50])
+def test_prewhiten(years):
+    pytest.importorskip("statsmodels")
+    import runTrendAnalysis
+    array = cube(years,missing=0)
+    pw, mask = batchTrend.prewhiten(array)
+    for d in range(array.shape[0]):
+        for c in range(array.shape[2]):
+            ts = array[d,:,c]
+            assert mask[d,c] == runTrendAnalysis.autocorrTest(ts)
+            assert np.allclose(pw[d,:,c],runTrendAnalysis.prewhiten(ts) if mask[d,c] else ts)
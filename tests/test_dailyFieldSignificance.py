@@ -0,0 +1,28 @@
+"""
+    Field significance of several regions from one cube, see dailyFieldSignificance.fieldSignGroups.
+    """
+
+import numpy as np
+import pytest
+import kernels
+
+# benchmark and dailyFieldSignificance import the trend module
+pytest.importorskip("trendmaster.trend")
+import benchmark
+import dailyFieldSignificance
+
+@pytest.mark.parametrize("backend",["numpy",pytest.param("numba",marks=pytest.mark.skipif(not kernels.NUMBA,
+                                                                                            reason="numba is not installed"))])
+def test_fieldSignGroups(backend):
+    rng = np.random.default_rng(3)
+    cube = benchmark.syntheticCube(9,30,seed=0)[:40]
+    cube[rng.random(cube.shape)<0.03] = np.nan
+    groups = np.array(["a"]*3+["b"]*4+["c"]*2)
+    result = dailyFieldSignificance.fieldSignGroups(cube,groups,NS=30,seed=5,chunk=15,backend=backend)
+    # each region as if analysed on its own array, the first catchment of the region decides valid samples
+    for g in ("a","b","c"):
+        reference = dailyFieldSignificance.fieldSignDaily(cube[:,:,groups==g],NS=30,seed=5)
+        assert np.allclose(result[g].pcrit,reference.pcrit,rtol=0,atol=1e-12,equal_nan=True)
+        assert np.allclose(result[g].percentSign,reference.percentSign)
+    reference = dailyFieldSignificance.fieldSignDaily(cube,NS=30,seed=5)
+    assert np.allclose(result["norway"].pcrit,reference.pcrit,rtol=0,atol=1e-12,equal_nan=True)
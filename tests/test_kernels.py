@@ -0,0 +1,115 @@
+"""
+    Parity of the "numpy", "numba" and "trend" backends of the trend analysis and
+    the field significance bootstrap, see kernels.py.
+    """
+
+import os
+import subprocess
+import sys
+import textwrap
+import numpy as np
+import pytest
+import batchTrend
+import bootstrap
+import kernels
+import compactCube
+
+# benchmark imports runTrendAnalysis, which needs the trend module
+trend = pytest.importorskip("trendmaster.trend")
+import benchmark
+import runTrendAnalysis
+import dailyFieldSignificance
+
+numba = pytest.mark.skipif(not kernels.NUMBA,reason="numba is not installed")
+BACKENDS = ["numpy",pytest.param("numba",marks=numba),"trend"]
+
+def cube(catchments=6,years=30,days=120,seed=0):
+    """
+    Synthetic (doy,year,catchment) cube with missing values and a catchment without data.
+    """
+    array = benchmark.syntheticCube(catchments,years,seed=seed)[:days]
+    array[:,:,-1] = -99
+    return array
+
+@numba
+@pytest.mark.parametrize("years",[30,50])
+def test_mannKendall(years):
+    array = cube(years=years)
+    p, s = batchTrend.mannKendall(array)
+    pk, sk = kernels.mannKendall(array)
+    assert np.allclose(pk,p,rtol=0,atol=1e-12,equal_nan=True)
+    assert np.array_equal(sk,s,equal_nan=True)
+
+@pytest.mark.filterwarnings("ignore::FutureWarning")
+@pytest.mark.parametrize("backend",BACKENDS)
+def test_trendSeries(backend):
+    array = cube()
+    reference = runTrendAnalysis.trendMagnitude(array,backend="numpy")
+    result = runTrendAnalysis.trendMagnitude(array,backend=backend)
+    assert np.array_equal(np.isnan(result),np.isnan(reference))
+    assert np.allclose(result,reference,rtol=1e-12,atol=1e-12,equal_nan=True)
+
+@pytest.mark.parametrize("backend",["numpy",pytest.param("numba",marks=numba)])
+def test_trendBundleFloat32(backend):
+    # a compact cube is analysed in float32 with the results of float64 up to float32 rounding
+    array, valid = compactCube.compress(cube())
+    reference = batchTrend.trendBundle(array.astype(float),backend=backend,valid=valid)
+    bundle = batchTrend.trendBundle(array,backend=backend,valid=valid)
+    assert np.array_equal(bundle["pvalue"],reference["pvalue"],equal_nan=True)
+    assert np.array_equal(bundle["prewhitened"],reference["prewhitened"])
+    assert np.allclose(bundle["slope"],reference["slope"],rtol=1e-5,atol=1e-6,equal_nan=True)
+
+@pytest.mark.parametrize("backend",BACKENDS)
+def test_bootstrapSignificance(backend):
+    array = cube(days=20)
+    reference = dailyFieldSignificance.fieldSignDaily(array,NS=20,seed=1,backend="numpy")
+    result = dailyFieldSignificance.fieldSignDaily(array,NS=20,seed=1,backend=backend)
+    assert np.allclose(result.pcrit,reference.pcrit,rtol=0,atol=1e-12,equal_nan=True)
+    assert np.array_equal(result.fieldSignificant,reference.fieldSignificant)
+
+@numba
+def test_bootstrapSignificanceKernel():
+    array = cube(days=20)
+    table = bootstrap.resamplingTable(10,array.shape[0],array.shape[1],seed=2)
+    reference = bootstrap.bootstrapSignificance(array,table,backend="numpy")
+    assert np.allclose(kernels.bootstrapSignificance(array,table),reference,rtol=0,atol=1e-12,equal_nan=True)
+
+@pytest.mark.parametrize("backend",["numpy",pytest.param("numba",marks=numba)])
+def test_bootstrapPValues(backend):
+    array = cube(days=20)
+    table = bootstrap.resamplingTable(10,array.shape[0],array.shape[1],seed=2)
+    p = bootstrap.bootstrapPValues(array,table,backend=backend)
+    # trend.mann_kendall on the resampled series
+    for i in range(0,table.shape[0],3):
+        resampled = bootstrap.applyTable(array,table[i])
+        finite = np.isfinite(resampled[:,:,0]).all(axis=1)
+        reference = np.array([[trend.mann_kendall(resampled[d,:,c]) for c in range(array.shape[2])]
+                              for d in range(array.shape[0])])
+        assert np.isnan(p[i][~finite]).all()
+        assert np.allclose(p[i][finite],reference[finite],rtol=0,atol=1e-6)
+
+def test_bootstrapPValuesWorkers():
+    array = cube(days=20)
+    table = bootstrap.resamplingTable(10,array.shape[0],array.shape[1],seed=2)
+    assert np.array_equal(bootstrap.bootstrapPValues(array,table,workers=2),bootstrap.bootstrapPValues(array,table),
+                          equal_nan=True)
+
+@numba
+def test_numbaThenPool(tmp_path):
+    # a process pool started after the threaded numba kernels ran used to hang at exit
+    script = tmp_path/"numbaThenPool.py"
+    script.write_text(textwrap.dedent("""
+        import numpy as np
+        import benchmark
+        import bootstrap
+        import kernels
+
+        if __name__ == "__main__":
+            array = benchmark.syntheticCube(4,30,seed=0)[:10]
+            table = bootstrap.resamplingTable(6,array.shape[0],array.shape[1],seed=0)
+            reference = kernels.bootstrapSignificance(array,table)
+            result = bootstrap.bootstrapSignificance(array,table,workers=3)
+            assert np.allclose(result,reference,equal_nan=True)
+        """))
+    env = dict(os.environ,PYTHONPATH=os.pathsep.join(sys.path))
+    subprocess.run([sys.executable,str(script)],env=env,check=True,timeout=300)